@@ -8,13 +8,42 @@ http://www.nedbatchelder.com
 """
 
 import ftplib, pickle, sys, hashlib, os, string
-import logging
+import concurrent.futures, logging, threading
 
 from path import Path
 
+from . import XuffIndex
+from . import XuffTrace
+
 __version__ = '1.0a'
 __all__ = ['FtpUpload']
 
+# The first line of a tracking file that has stat signatures starts with
+# this, followed by the name of the hash algorithm.  The rest of the lines
+# are "hash size mtime_ns inode filename".  A hash made with a different
+# algorithm than the header's is written "algorithm:hash".
+HEADER = "# FtpUpload "
+
+# Files are hashed in chunks this big, rather than read whole.
+HASH_CHUNK = 1024 * 1024
+
+def hashFile(path, names):
+    """
+    Hash the file at `path` with each of the hashlib algorithms in `names`,
+    reading it just once.  Returns a list of "algorithm:hexdigest" strings.
+    """
+    hashers = [hashlib.new(name) for name in names]
+    buf = bytearray(HASH_CHUNK)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for h in hashers:
+                h.update(view[:n])
+    return ["%s:%s" % (name, h.hexdigest()) for name, h in zip(names, hashers)]
+
 class Tracer:
     def __init__(self, name, fout):
         self.myname = name
@@ -86,7 +115,7 @@ class EzFtp:
         """
         thatDir, thatFile = os.path.split(that)
         self.cd(thatDir)
-        with open(this, "rb") as f:
+        with open(this, "rb") as f, XuffTrace.span('ftpstorasc', 'ftp', path=that):
             logging.info("ftpstorasc %s" % that)
             self.ftp.storlines("STOR "+thatFile, f)
 
@@ -96,7 +125,7 @@ class EzFtp:
         """
         thatDir, thatFile = os.path.split(that)
         self.cd(thatDir)
-        with open(this, "rb") as f:
+        with open(this, "rb") as f, XuffTrace.span('ftpstorbin', 'ftp', path=that):
             logging.info("ftpstorbin %s" % that)
             self.ftp.storbinary("STOR "+thatFile, f)
 
@@ -107,10 +136,11 @@ class EzFtp:
         thatDir, thatFile = os.path.split(that)
         if self.cd(thatDir, create=False):
             logging.info("ftpdel %s" % that)
-            try:
-                self.ftp.delete(thatFile)
-            except:
-                pass
+            with XuffTrace.span('ftpdel', 'ftp', path=that):
+                try:
+                    self.ftp.delete(thatFile)
+                except:
+                    pass
 
     def quit(self):
         """
@@ -121,17 +151,33 @@ class EzFtp:
 
 class FtpUpload:
     """
-    Provides intelligent FTP uploading of files, using MD5 hashes to track
+    Provides intelligent FTP uploading of files, using hashes to track
     which files have to be uploaded.  Each upload is recorded in a local
     file so that the next upload can skip the file if its contents haven't
-    changed.  File timestamps are ignored, allowing regenerated files to
-    be properly uploaded only if their contents have changed.
+    changed.  File timestamps don't decide anything, allowing regenerated
+    files to be properly uploaded only if their contents have changed.
+
+    The tracking file also records each file's size, mtime and inode.  A
+    file whose stat signature is unchanged isn't read and hashed again,
+    unless `upload` is asked to `verify`.
+
+    Files are hashed with BLAKE2b unless `setHashName` picks another
+    hashlib algorithm.  Each hash in the tracking file is labelled with its
+    algorithm, so files tracked with another one (including MD5 in older
+    tracking files) are checked with that, and then tracked with the new.
 
     Call `setHost` and `setMd5File` to establish the settings for a session,
     then `upload` for each set of files to upload.  If you want to have
     removed local files automatically delete the remote files, call
     `deleteOldFiles` once, then `finish` to perform the closing bookkeeping.
 
+    With `connections` greater than one in `setHost`, changed files are
+    uploaded over that many connections at once.
+
+    `index` is an XuffIndex.DirIndex to list directories with, shared with
+    the rest of a xuff run.  Without one, every `upload` lists its tree
+    afresh.
+
     ::
 
         fu = FtpUpload()
@@ -147,49 +193,101 @@ class FtpUpload:
 
     """
 
-    def __init__(self):
+    def __init__(self, index=None):
         self.ftp = None
+        self.index = index
         self.ezftp = None
+        self.host = None
+        self.connections = 1
         self.md5file = None
         self.md5DictIn = {}
         self.md5DictOut = {}
         self.md5DictUp = {}
-
-    def setHost(self, host, username, password):
+        self.hashName = 'blake2b'
+        self.statDictIn = {}
+        self.statDictUp = {}
+        self.nhashed = 0
+        self.ntrusted = 0
+        self.md5Lock = threading.RLock()
+        self.nchanged = 0
+
+    def setHost(self, host, username, password, connections=1):
         """
-        Set the host, the username and password.
+        Set the host, the username and password, and how many connections
+        to upload over.
         """
         assert not self.ftp
-        self.ftp = ftplib.FTP(host, username, password)
-        self.ftp.set_pasv(1)
-        #self.ftp.set_debuglevel(2)
+        self.host = (host, username, password)
+        self.connections = connections
+        self.ftp = self.connect()
+
+    def connect(self):
+        """
+        Make a new connection to the host.
+        """
+        ftp = ftplib.FTP(*self.host)
+        ftp.set_pasv(1)
+        #ftp.set_debuglevel(2)
 
         # 2.7.8 added a maxline of 8192, which is not long enough.
-        self.ftp.maxline = 300000
+        ftp.maxline = 300000
+        return ftp
+
+    def setHashName(self, name):
+        """
+        Choose the hashlib algorithm to fingerprint files with.
+        """
+        hashlib.new(name)
+        self.hashName = name
 
     def setMd5File(self, md5file):
         """
-        Assign a filename to use for the MD5 tracking.
+        Assign a filename to use for the hash tracking.  Older tracking
+        files, pickles or lines of "md5 filename", are read too, and
+        `writeMd5` writes them in the current format.
         """
         self.md5file = md5file
         if self.md5file:
             try:
-                with open(self.md5file, "r") as inf:
-                    first = inf.read(1)
-                    inf.seek(0)
-                    if first == "(":
-                        # Old pickle
-                        self.md5DictIn = pickle.load(inf)
-                    else:
-                        for line in inf:
-                            line = line.rstrip()
-                            if not line:
-                                continue
-                            md5hash, filename = line.split(' ', 1)
-                            self.md5DictIn[filename] = md5hash
+                self.readMd5File()
                 self.md5DictUp.update(self.md5DictIn)
+                self.statDictUp.update(self.statDictIn)
             except IOError:
                 self.md5DictIn = {}
+                self.statDictIn = {}
+
+    def readMd5File(self):
+        with open(self.md5file, "rb") as inf:
+            first = inf.read(1)
+            if first in (b"(", b"\x80"):
+                # Old pickle of MD5s, probably from Python 2.
+                inf.seek(0)
+                md5s = pickle.load(inf, encoding='latin1')
+                self.md5DictIn = dict((filename, "md5:" + md5hash) for filename, md5hash in md5s.items())
+                return
+
+        with open(self.md5file, "r") as inf:
+            header = inf.readline().rstrip('\n')
+            if header.startswith(HEADER):
+                defaultName = header[len(HEADER):]
+                for line in inf:
+                    line = line.rstrip('\n')
+                    if not line:
+                        continue
+                    filehash, size, mtime, inode, filename = line.split(' ', 4)
+                    if ':' not in filehash:
+                        filehash = defaultName + ":" + filehash
+                    self.md5DictIn[filename] = filehash
+                    if size != '-':
+                        self.statDictIn[filename] = (int(size), int(mtime), int(inode))
+            else:
+                inf.seek(0)
+                for line in inf:
+                    line = line.rstrip()
+                    if not line:
+                        continue
+                    md5hash, filename = line.split(' ', 1)
+                    self.md5DictIn[filename] = "md5:" + md5hash
 
     def upload(self,
                hostdir='.',
@@ -198,6 +296,7 @@ class FtpUpload:
                src='.',
                only=None,
                skip=None,
+               verify=False,
                ):
         """
         Upload a set of files.
@@ -210,6 +309,8 @@ class FtpUpload:
 
         `only` is an fnmatch pattern to limit the files we consider.
         `skip` is an fnmatch pattern to skip certain files.
+        `verify` means hash every file, even those whose stat signature
+        hasn't changed.
 
         This method can be called a number of times to upload different
         sets of files to or from different directories within the same
@@ -224,18 +325,24 @@ class FtpUpload:
         if hostdir != '.':
             self.ezftp.setRoot(hostdir)
 
-        # patdict is a dict of fnmatch patterns to ftp function.
+        # patdict is a dict of fnmatch patterns to the name of the EzFtp
+        # method to put them with.
         patdict = {}
         for pat in text.split():
-            patdict[pat] = self.ezftp.putasc
+            patdict[pat] = 'putasc'
         for pat in binary.split():
-            patdict[pat] = self.ezftp.putbin
+            patdict[pat] = 'putbin'
 
-        nchanged = 0
+        # The files to put, as (thispath, thatpath, ftpfn, hash, stat signature) tuples.
+        changed = []
 
-        # Walk the tree, putting files to the ezftp.
+        # Walk the tree, putting files to the ezftp.  If we were given an
+        # index (xuff's for the run), the listings come from it, so trees
+        # already walked aren't listed again.  Otherwise list afresh.
         srcpath = Path(src)
-        for thispath in sorted(srcpath.walkfiles()):
+        index = self.index or XuffIndex.DirIndex()
+        entries = dict(index.walkfiles(src))
+        for thispath in sorted(Path(p) for p in entries):
             if only:
                 if not thispath.fnmatch(only):
                     continue
@@ -255,26 +362,119 @@ class FtpUpload:
 
             thatpath = srcpath.relpathto(thispath)
             thatpathstr = str(thatpath)
-            # Compute this file's MD5 fingerprint
-            m = hashlib.md5()
-            with open(thispath, "rb") as f:
-                m.update(f.read())
-            thisMd5 = m.hexdigest()
 
-            # What was the last MD5 fingerprint?
-            thatMd5 = self.md5DictIn.get(thatpathstr, '')
+            # What was the last fingerprint, and what algorithm made it?
+            thatHash = self.md5DictIn.get(thatpathstr, '')
+            thatName = thatHash.partition(':')[0]
+
+            # If the file's stat signature hasn't changed, its fingerprint
+            # hasn't either.  Otherwise compute it, and if the last one was
+            # made with another algorithm, compute that one too to compare.
+            st = entries[str(thispath)].stat()
+            thisSig = (st.st_size, st.st_mtime_ns, st.st_ino)
+            sameSig = not verify and thatHash and self.statDictIn.get(thatpathstr) == thisSig
+            if sameSig and thatName == self.hashName:
+                thisHash = thatHash
+                same = True
+                self.ntrusted += 1
+            else:
+                names = [self.hashName]
+                if thatHash and thatName != self.hashName and not sameSig:
+                    names.append(thatName)
+                with XuffTrace.span('hash', 'ftp', path=thatpathstr):
+                    hashes = hashFile(thispath, names)
+                thisHash = hashes[0]
+                if len(hashes) > 1:
+                    same = hashes[1] == thatHash
+                elif thatName == self.hashName or not thatHash:
+                    same = thisHash == thatHash
+                else:
+                    # Same stat as when the old-algorithm hash was made.
+                    same = True
+                self.nhashed += 1
 
             # Remember the new fingerprint.
-            self.md5DictOut[thatpathstr] = thisMd5
-            self.md5DictUp[thatpathstr] = thisMd5
+            self.md5DictOut[thatpathstr] = thisHash
 
             # If the current file is different, then put it to the server.
-            if thisMd5 != thatMd5:
-                ftpfn(thispath, thatpath)
-
-                nchanged += 1
-                if nchanged % 30 == 0:
-                    self.writeMd5()
+            if not same:
+                changed.append((thispath, thatpath, ftpfn, thisHash, thisSig))
+            else:
+                self.md5DictUp[thatpathstr] = thisHash
+                self.statDictUp[thatpathstr] = thisSig
+
+        logging.info("%d files hashed, %d unchanged by stat" % (self.nhashed, self.ntrusted))
+        if self.connections > 1 and len(changed) > 1:
+            self.putParallel(changed, hostdir)
+        else:
+            for thispath, thatpath, ftpfn, thisHash, thisSig in changed:
+                getattr(self.ezftp, ftpfn)(thispath, thatpath)
+                self.uploaded(thatpath, thisHash, thisSig)
+
+    def uploaded(self, thatpath, thisHash, thisSig):
+        """
+        Record that `thatpath` is on the server with hash `thisHash`, from a
+        file with stat signature `thisSig`.
+        """
+        with self.md5Lock:
+            self.md5DictUp[str(thatpath)] = thisHash
+            self.statDictUp[str(thatpath)] = thisSig
+            self.nchanged += 1
+            if self.nchanged % 30 == 0:
+                self.writeMd5()
+
+    def putParallel(self, changed, hostdir):
+        """
+        Put the `changed` files over `self.connections` connections, the
+        first of them our own.  Files are handed out in runs from one remote
+        directory, biggest first, so each connection mostly stays in one
+        directory.  Big directories are split into several runs, so a deploy
+        that's mostly one directory still uses all the connections.
+        """
+        byDir = {}
+        for item in changed:
+            byDir.setdefault(str(item[1].parent), []).append(item)
+        runLen = max(1, -(-len(changed) // (self.connections * 4)))
+        runs = []
+        for group in byDir.values():
+            for i in range(0, len(group), runLen):
+                runs.append(group[i:i+runLen])
+        runs.sort(key=len, reverse=True)
+        lock = threading.Lock()
+        failed = []
+
+        def putRuns(n):
+            if n == 0:
+                ezftp = self.ezftp
+            else:
+                if self.host:
+                    ftp = self.connect()
+                else:
+                    ftp = Tracer('ftp%d' % n, sys.stdout)
+                ezftp = EzFtp(ftp)
+                if hostdir != '.':
+                    ezftp.setRoot(hostdir)
+            try:
+                while not failed:
+                    with lock:
+                        if not runs:
+                            break
+                        run = runs.pop(0)
+                    for thispath, thatpath, ftpfn, thisHash, thisSig in run:
+                        getattr(ezftp, ftpfn)(thispath, thatpath)
+                        self.uploaded(thatpath, thisHash, thisSig)
+            except:
+                failed.append(True)
+                raise
+            finally:
+                if n != 0:
+                    ezftp.quit()
+
+        nconn = min(self.connections, len(runs))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nconn) as pool:
+            futures = [pool.submit(putRuns, n) for n in range(nconn)]
+        for fut in futures:
+            fut.result()
 
     def deleteOldFiles(self):
         """
@@ -289,6 +489,7 @@ class FtpUpload:
             if this not in self.md5DictOut:
                 self.ezftp.delete(this)
                 del self.md5DictUp[this]
+                self.statDictUp.pop(this, None)
 
     def finish(self):
         """
@@ -300,8 +501,13 @@ class FtpUpload:
         self.writeMd5()
 
     def writeMd5(self):
-        # Write the md5 control file out for next time.
+        # Write the hash control file out for next time.
         if self.md5file:
-            with open(self.md5file, "w") as outf:
-                for filename, md5hash in sorted(self.md5DictUp.items()):
-                    outf.write("{} {}\n".format(md5hash, filename))
+            prefix = self.hashName + ":"
+            with self.md5Lock, open(self.md5file, "w") as outf:
+                outf.write(HEADER + self.hashName + "\n")
+                for filename, filehash in sorted(self.md5DictUp.items()):
+                    if filehash.startswith(prefix):
+                        filehash = filehash[len(prefix):]
+                    size, mtime, inode = self.statDictUp.get(filename, ('-', '-', '-'))
+                    outf.write("{} {} {} {} {}\n".format(filehash, size, mtime, inode, filename))
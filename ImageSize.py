@@ -0,0 +1,127 @@
+"""
+ImageSize
+
+Get the dimensions of an image by reading just enough of its header,
+rather than having PIL open the whole thing.  PNG, GIF, JPEG, WebP and
+SVG are read directly; anything else falls back to PIL.
+"""
+
+import re
+import struct
+import xml.etree.ElementTree as ET
+
+__all__ = ['imageSize']
+
+def imageSize(path):
+    """
+    Return the (width, height) of the image at `path`, or None if it can't
+    be determined.  Raises IOError if the file can't be read.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(32)
+        for reader in _readers:
+            size = reader(f, head)
+            if size is not None:
+                return size
+    return _pilSize(path)
+
+def _pngSize(f, head):
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR' and len(head) >= 24:
+        return struct.unpack('>II', head[16:24])
+
+def _gifSize(f, head):
+    if head[:6] in (b'GIF87a', b'GIF89a') and len(head) >= 10:
+        return struct.unpack('<HH', head[6:10])
+
+# JPEG markers that aren't followed by a segment length.
+_JPEG_STANDALONE = set([0x01, 0xD8] + list(range(0xD0, 0xD8)))
+# The start-of-frame markers, which hold the dimensions.
+_JPEG_SOF = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+def _jpegSize(f, head):
+    if head[:2] != b'\xff\xd8':
+        return None
+    f.seek(2)
+    while True:
+        b = f.read(1)
+        while b and b != b'\xff':
+            b = f.read(1)
+        while b == b'\xff':
+            b = f.read(1)
+        if not b:
+            return None
+        marker = b[0]
+        if marker in _JPEG_STANDALONE:
+            continue
+        if marker == 0xD9:
+            return None
+        seglen = f.read(2)
+        if len(seglen) != 2:
+            return None
+        seglen = struct.unpack('>H', seglen)[0]
+        if marker in _JPEG_SOF:
+            data = f.read(5)
+            if len(data) != 5:
+                return None
+            height, width = struct.unpack('>xHH', data)
+            return width, height
+        f.seek(seglen - 2, 1)
+
+def _webpSize(f, head):
+    if head[:4] != b'RIFF' or head[8:12] != b'WEBP' or len(head) < 30:
+        return None
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3fff, height & 0x3fff
+    elif chunk == b'VP8L' and head[20:21] == b'\x2f':
+        bits = struct.unpack('<I', head[21:25])[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif chunk == b'VP8X':
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+        return width, height
+    return None
+
+_svgLength = re.compile(r"^\s*([0-9]*\.?[0-9]+)\s*(px)?\s*$")
+
+def _svgSize(f, head):
+    if not head.lstrip().startswith(b'<'):
+        return None
+    f.seek(0)
+    try:
+        for event, elem in ET.iterparse(f, events=('start',)):
+            break
+        else:
+            return None
+    except ET.ParseError:
+        return None
+    if elem.tag not in ('svg', '{http://www.w3.org/2000/svg}svg'):
+        return None
+
+    def length(name):
+        m = _svgLength.match(elem.get(name) or '')
+        return float(m.group(1)) if m else None
+
+    width, height = length('width'), length('height')
+    try:
+        viewBox = [float(v) for v in (elem.get('viewBox') or '').replace(',', ' ').split()]
+    except ValueError:
+        viewBox = []
+    if len(viewBox) == 4:
+        vbWidth, vbHeight = viewBox[2], viewBox[3]
+        if width is None and height is None:
+            width, height = vbWidth, vbHeight
+        elif height is None and vbWidth:
+            height = width * vbHeight / vbWidth
+        elif width is None and vbHeight:
+            width = height * vbWidth / vbHeight
+    if width is None or height is None:
+        return None
+    return int(round(width)), int(round(height))
+
+_readers = [_pngSize, _gifSize, _jpegSize, _webpSize, _svgSize]
+
+def _pilSize(path):
+    from PIL import Image
+    return Image.open(path).size
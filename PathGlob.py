@@ -6,50 +6,100 @@ import os
 import fnmatch
 import re
 
-__all__ = ["glob"]
+__all__ = ["glob", "iglob"]
 
 def glob(pathname, deep=0):
     """
     Return a list of paths matching a pathname pattern.
 
     The pattern may contain simple shell-style wildcards a la fnmatch.
+    A `**` component matches any number of directories, including none,
+    or as the last component, everything below.
+    If `deep` is true, the last component is looked for in all the
+    subdirectories too, as if it were preceded by `**`.
 
     """
-    result = []
+    return list(iglob(pathname, deep))
+
+def iglob(pathname, deep=0):
+    """
+    Like `glob`, but yield the matching paths one at a time.
+    """
+    if deep:
+        dirname, basename = os.path.split(pathname)
+        pathname = os.path.join(dirname, '**', basename)
+    # Each directory is listed at most once per call.
+    return globPaths(pathname, False, {})
+
+def globPaths(pathname, dirsOnly, listings):
+    """
+    Yield the paths matching `pathname`, only directories if `dirsOnly`.
+    `listings` caches directory listings.
+    """
     if not hasMagic(pathname):
-        if os.path.exists(pathname):
-            result = [pathname]
+        if os.path.isdir(pathname) if dirsOnly else os.path.exists(pathname):
+            yield pathname
+        return
+
+    dirname, basename = os.path.split(pathname)
+    if hasMagic(dirname):
+        dirs = globPaths(dirname, True, listings)
     else:
-        dirname, basename = os.path.split(pathname)
+        dirs = [dirname]
+
+    if basename == '**':
+        for dirname in dirs:
+            if dirsOnly:
+                yield dirname
+            elif dirname:
+                # Like the glob module, "a/**" includes "a/" itself.
+                yield os.path.join(dirname, '')
+            for name in globDeep(dirname, dirsOnly, listings):
+                yield name
+    elif not hasMagic(basename):
+        for dirname in dirs:
+            if basename or os.path.isdir(dirname):
+                name = os.path.join(dirname, basename)
+                if os.path.isdir(name) if dirsOnly else os.path.exists(name):
+                    yield name
+    else:
+        match = re.compile(fnmatch.translate(os.path.normcase(basename))).match
+        for dirname in dirs:
+            for entry in listDir(dirname, listings):
+                if match(os.path.normcase(entry.name)) and (not dirsOnly or isDir(entry)):
+                    yield os.path.join(dirname, entry.name)
+
+def globDeep(dirname, dirsOnly, listings):
+    """
+    Yield everything below `dirname`, only directories if `dirsOnly`.
+    Symlinks to directories aren't followed.
+    """
+    for entry in listDir(dirname, listings):
+        name = os.path.join(dirname, entry.name)
+        if isDir(entry, follow_symlinks=False):
+            yield name
+            for sub in globDeep(name, dirsOnly, listings):
+                yield sub
+        elif not dirsOnly:
+            yield name
+
+def listDir(dirname, listings):
+    """The os.DirEntry's in `dirname`, listed only once per `listings`."""
+    entries = listings.get(dirname)
+    if entries is None:
+        try:
+            with os.scandir(dirname or os.curdir) as it:
+                entries = list(it)
+        except OSError:
+            entries = []
+        listings[dirname] = entries
+    return entries
 
-        if not dirname:
-            result = globInDir(os.curdir, basename)
-        else:
-            if hasMagic(dirname):
-                dirs = glob(dirname, deep)
-            else:
-                dirs = [dirname]
-
-            if not hasMagic(basename):
-                for dirname in dirs:
-                    if basename or os.path.isdir(dirname):
-                        name = os.path.join(dirname, basename)
-                        if os.path.exists(name):
-                            result.append(name)
-            else:
-                for dirname in dirs:
-                    sublist = globInDir(dirname, basename)
-                    for name in sublist:
-                        result.append(os.path.join(dirname, name))
-
-    return result
-
-def globInDir(dirname, pattern):
+def isDir(entry, follow_symlinks=True):
     try:
-        names = os.listdir(dirname or os.curdir)
-    except os.error:
-        return []
-    return fnmatch.filter(names,pattern)
+        return entry.is_dir(follow_symlinks=follow_symlinks)
+    except OSError:
+        return False
 
 
 magicCheck = re.compile('[*?[]')
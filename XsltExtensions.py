@@ -2,12 +2,17 @@
 ##  XSLT extension functions.
 ##
 
+import collections
+import hashlib
+import json
 import os
 import re
+import tempfile
+import threading
 import time
 import urllib.parse
 
-from PIL import Image
+from .ImageSize import imageSize
 
 def endswith(text, s):
     return int(bool(text.endswith(s)))
@@ -69,8 +74,159 @@ def slugfromtext(txt):
 
 idfromtext = slugfromtext
 
-def lexcode(code, lang, number=False):
-    import pygments, pygments.lexers, pygments.formatters
+class RenderCache:
+    """
+    HTML rendered by an extension function like lexcode or markdown, so
+    that unchanged text isn't rendered again.  Results are keyed by a hash
+    of the arguments and of `version()`, the version of the renderer.
+
+    The most recently used `maxEntries` results are kept in memory.  If
+    `dirname` is set, results are also kept there, one file each, so they
+    last from one run to the next, and worker processes can share them.
+    `prune` trims the directory to the `maxEntries` most recently used.
+    """
+    def __init__(self, name, version, dirname=None, maxEntries=10000):
+        self.name = name
+        self.version = version
+        self.dirname = dirname
+        self.maxEntries = maxEntries
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+    def key(self, *args):
+        data = repr((args, self.version()))
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def render(self, fn, *args):
+        """Return the cached result of `fn(*args)`, calling it if needed."""
+        key = self.key(*args)
+        result = self.get(key)
+        if result is None:
+            result = fn(*args)
+            self.put(key, result)
+        return result
+
+    def has(self, key):
+        """Is there a result for `key`?  Doesn't count as a use."""
+        if key in self.memory:
+            return True
+        return bool(self.dirname) and os.path.exists(self.filename(key))
+
+    def filename(self, key):
+        return os.path.join(self.dirname, key[:2], key + '.html')
+
+    def get(self, key):
+        """Return the HTML stored for `key`, or None."""
+        with self.lock:
+            html = self.memory.get(key)
+            if html is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return html
+        if self.dirname:
+            fname = self.filename(key)
+            try:
+                with open(fname, encoding='utf-8') as f:
+                    html = f.read()
+                # The mtime is the last use, for pruning.
+                os.utime(fname)
+            except OSError:
+                html = None
+            if html is not None:
+                self.remember(key, html)
+                with self.lock:
+                    self.diskHits += 1
+                return html
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, html):
+        """Store `html` for `key`."""
+        self.remember(key, html)
+        if self.dirname:
+            fname = self.filename(key)
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            # Threads in one process may put the same key at once: each
+            # needs its own temporary file.
+            fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(fname))
+            with open(fd, 'w', encoding='utf-8') as f:
+                f.write(html)
+            os.replace(tmpname, fname)
+
+    def remember(self, key, html):
+        with self.lock:
+            self.memory[key] = html
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.maxEntries:
+                self.memory.popitem(last=False)
+
+    def prune(self):
+        """Delete the least recently used files beyond `maxEntries`."""
+        if not self.dirname or not os.path.isdir(self.dirname):
+            return
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.dirname):
+            for f in filenames:
+                fname = os.path.join(dirpath, f)
+                try:
+                    files.append((os.stat(fname).st_mtime, fname))
+                except OSError:
+                    pass
+        files.sort()
+        for mtime, fname in files[:max(0, len(files) - self.maxEntries)]:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+    def report(self):
+        total = self.hits + self.diskHits + self.misses
+        rate = 100.0 * (self.hits + self.diskHits) / total if total else 0.0
+        return "%s: %d hits (%d from disk), %d rendered, %.1f%% hit rate" % (
+            self.name, self.hits + self.diskHits, self.diskHits, self.misses, rate
+            )
+
+    def takeCounters(self):
+        counters = (self.hits, self.diskHits, self.misses)
+        self.hits = self.diskHits = self.misses = 0
+        return counters
+
+    def addCounters(self, counters):
+        hits, diskHits, misses = counters
+        self.hits += hits
+        self.diskHits += diskHits
+        self.misses += misses
+
+def _pygmentsVersion():
+    import pygments
+    return pygments.__version__
+
+def _markdownVersion():
+    import markdown2
+    return markdown2.__version__
+
+lexcodeCache = RenderCache('lexcode', _pygmentsVersion)
+markdownCache = RenderCache('markdown', _markdownVersion)
+renderCaches = {
+    'lexcode': lexcodeCache,
+    'markdown': markdownCache,
+    }
+
+# The pygments machinery for lexcode, made once per process.
+_lexers = {}
+_formatters = {}
+_CodeHtmlFormatter = None
+
+def _codeHtmlFormatter():
+    global _CodeHtmlFormatter
+    if _CodeHtmlFormatter is not None:
+        return _CodeHtmlFormatter
+
+    import pygments.formatters
     # Because we are omitting the <pre> wrapper, we need spaces to become &nbsp;.
     import pygments.formatters.html as pfh
     pfh._escape_html_table.update({ord(' '): u'&#xA0;'})
@@ -105,6 +261,25 @@ def lexcode(code, lang, number=False):
                 yield i, t
             # yield 0, '</pre>'
 
+    _CodeHtmlFormatter = CodeHtmlFormatter
+    return _CodeHtmlFormatter
+
+def _lexer(lang):
+    lexer = _lexers.get(lang)
+    if lexer is None:
+        import pygments.lexers
+        lexer = _lexers[lang] = pygments.lexers.get_lexer_by_name(lang, stripall=True)
+    return lexer
+
+def _formatter(number):
+    linenos = 'inline' if number else False
+    formatter = _formatters.get(linenos)
+    if formatter is None:
+        formatter = _formatters[linenos] = _codeHtmlFormatter()(linenos=linenos, cssclass="source")
+    return formatter
+
+def lexcodeArgs(code, lang, number=False):
+    """Normalize the arguments to lexcode, as its cache sees them."""
     aliases = {
         "cs": "c#",
         "htaccess": "apacheconf",
@@ -113,44 +288,150 @@ def lexcode(code, lang, number=False):
         }
     lang = lang.lower()
     lang = aliases.get(lang, lang)
-    lexer = pygments.lexers.get_lexer_by_name(lang, stripall=True)
-    formatter = CodeHtmlFormatter(linenos='inline' if number else False, cssclass="source")
-    result = pygments.highlight(code, lexer, formatter)
-    return result
+    return code, lang, bool(number)
 
+def _renderLexcode(code, lang, number):
+    import pygments
+    return pygments.highlight(code, _lexer(lang), _formatter(number))
 
-def markdown(text):
+def lexcode(code, lang, number=False):
+    return lexcodeCache.render(_renderLexcode, *lexcodeArgs(code, lang, number))
+
+
+def _renderMarkdown(text):
     import markdown2
     return markdown2.markdown(text)
 
+def markdown(text):
+    return markdownCache.render(_renderMarkdown, text)
+
+renderers = {
+    'lexcode': _renderLexcode,
+    'markdown': _renderMarkdown,
+    }
+
+def prerender(kind, args):
+    """
+    Render normalized `args` for the extension `kind` ('lexcode' or
+    'markdown'), as a worker process would for seeding the caches.
+    Returns (kind, key, html).
+    """
+    return kind, renderCaches[kind].key(*args), renderers[kind](*args)
+
 
-imgsizecache = {}
 curdir = os.getcwd()
 # Yuk! Hard-coded path!
 imgpath = [ curdir, os.path.join(curdir, 'public') ]
 
+class ImageSizeCache:
+    """
+    Image dimensions, keyed by the image reference used in the XSLT.
+
+    Each entry records the file the reference resolved to, with its size
+    and mtime, so that a changed image is measured again.  References that
+    couldn't be measured are remembered too, as entries with no dimensions.
+    Within a run, each reference is checked against the file system once;
+    after that, it's just a dict lookup.
+
+    If `fname` is set, the entries are loaded from and saved to that file,
+    so they last from one run to the next.
+    """
+    def __init__(self):
+        self.fname = None
+        self.entries = {}
+        self.checked = {}
+        self.updates = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, fname):
+        self.fname = fname
+        try:
+            with open(fname) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.checked = {}
+
+    def save(self):
+        if self.fname and self.updates:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            tmpname = "%s.%d.tmp" % (self.fname, os.getpid())
+            with open(tmpname, 'w') as f:
+                json.dump(self.entries, f, indent=0, sort_keys=True)
+            os.replace(tmpname, self.fname)
+            self.updates = {}
+
+    def newRun(self):
+        """Forget what was checked, so each reference is checked again."""
+        self.checked = {}
+
+    def resolve(self, s):
+        """Find the file for image reference `s`, or None."""
+        for p in imgpath:
+            spath = os.path.join(p, s)
+            if os.path.isfile(spath):
+                return spath
+        return None
+
+    def get(self, s):
+        """Return the (width, height) of image `s`, or None."""
+        try:
+            return self.checked[s]
+        except KeyError:
+            pass
+
+        path = self.resolve(s)
+        stamp = None
+        if path:
+            st = os.stat(path)
+            stamp = [st.st_size, st.st_mtime_ns]
+        entry = self.entries.get(s)
+        if entry is not None and entry['path'] == path and entry['stamp'] == stamp:
+            size = entry['size'] and tuple(entry['size'])
+            with self.lock:
+                self.hits += 1
+        else:
+            size = None
+            if path:
+                try:
+                    size = imageSize(path)
+                except IOError:
+                    pass
+            entry = {'path': path, 'stamp': stamp, 'size': size and list(size)}
+            with self.lock:
+                self.entries[s] = self.updates[s] = entry
+                self.misses += 1
+        if size is None:
+            print("Couldn't open image %s" % s)
+        self.checked[s] = size
+        return size
+
+    def takeUpdates(self):
+        """Return the entries changed so far, and forget they changed."""
+        with self.lock:
+            updates, self.updates = self.updates, {}
+        return updates
+
+    def addUpdates(self, updates):
+        """Add in entries from a worker's `takeUpdates`."""
+        with self.lock:
+            self.entries.update(updates)
+            self.updates.update(updates)
+
+    def report(self):
+        return "images: %d sizes reused, %d measured" % (self.hits, self.misses)
+
+imgsizecache = ImageSizeCache()
+
 def getImageSize(s):
     if s.startswith('http://') or s.startswith('file://'):
         return
     if s.startswith('//'):
         # Turn "//domain.com/path/to/file" into "path/to/file"
         s = s.split('/', maxsplit=3)[3]
-    if s not in imgsizecache:
-        img = None
-        for p in imgpath:
-            try:
-                spath = os.path.join(p, s)
-                img = Image.open(spath)
-                #print("opened %r" % s)
-                break
-            except IOError as msg:
-                pass
-        if img:
-            imgsizecache[s] = img.size
-        else:
-            print("Couldn't open image %s" % s)
-    if s in imgsizecache:
-        return imgsizecache[s]
+    return imgsizecache.get(s)
 
 def imgwidth(s, scale=None):
     return img_dimension(0, s, scale)
@@ -165,3 +446,54 @@ def img_dimension(which, s, scale=None):
         return str(int(size[which]*float(scale)))
     else:
         return ''
+
+# The directory for caches that last between runs, if any.
+cacheDir = None
+
+def cacheSettings():
+    """The cache configuration, to pass along to worker processes."""
+    return {
+        'dirname': cacheDir,
+        'renderMax': lexcodeCache.maxEntries,
+        }
+
+def configureCaches(dirname=None, renderMax=10000):
+    """
+    Set up the extension function caches.  If `dirname` is given, they are
+    kept in that directory from one run to the next.
+    """
+    global cacheDir
+    cacheDir = dirname
+    for name, cache in renderCaches.items():
+        cache.dirname = os.path.join(dirname, name) if dirname else None
+        cache.maxEntries = renderMax
+    if dirname:
+        imgsizecache.load(os.path.join(dirname, 'images.json'))
+
+def saveCaches():
+    """Write out the caches that are saved at the end of a run."""
+    for cache in renderCaches.values():
+        cache.prune()
+    imgsizecache.save()
+
+def takeCacheUpdates():
+    """
+    Return what the caches have learned, and reset their counters, to send
+    back from a worker process.
+    """
+    updates = {
+        'images': (imgsizecache.hits, imgsizecache.misses, imgsizecache.takeUpdates()),
+        }
+    imgsizecache.hits = imgsizecache.misses = 0
+    for name, cache in renderCaches.items():
+        updates[name] = cache.takeCounters()
+    return updates
+
+def addCacheUpdates(updates):
+    """Add in what a worker's caches learned, from `takeCacheUpdates`."""
+    for name, cache in renderCaches.items():
+        cache.addCounters(updates[name])
+    hits, misses, entries = updates['images']
+    imgsizecache.hits += hits
+    imgsizecache.misses += misses
+    imgsizecache.addUpdates(entries)
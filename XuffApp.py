@@ -8,22 +8,46 @@ http://www.nedbatchelder.com
 20021124 - Separated into stellated.XuffApp
 """
 
+import array
+import collections
+import concurrent.futures
+import copy
+import filecmp
+import io
+import json
 import logging
+import math
+import multiprocessing
 import os
 import re
 import shutil
 import sys
+import tempfile
+import threading
 import time
 
 from xml.dom import Node
 from lxml import etree
-from xml.sax import make_parser, handler, saxutils
+from xml.sax import saxutils
 import smartypants
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from . import walk
+from . import XuffCache
+from . import XuffDeps
+from . import XuffIndex
+from . import XuffSched
+from . import XuffTrace
 
 _verbose = 0
 
+# Threads to copy files with in <copytree>: it's mostly waiting on I/O.
+COPY_JOBS = 8
+
 class Timer:
     def __init__(self):
         self.start = time.time()
@@ -33,8 +57,9 @@ class Timer:
         print("Time: %s: %.2f sec" % (activity, now - self.start))
         self.start = now
 
-class XuffError:
+class XuffError(Exception):
     def __init__(self, msg):
+        Exception.__init__(self, msg)
         self.msg = msg
 
     def __repr__(self):
@@ -58,92 +83,188 @@ def makedirs(name):
         makedirs(head)
     if not os.path.exists(name):
         if _verbose > 1: print("mkdir", name)
-        os.mkdir(name)
+        try:
+            os.mkdir(name)
+        except FileExistsError:
+            # Another worker made it first.
+            pass
     else:
         if _verbose > 2: print("stat", name, os.stat(name))
 
-def prepareForOutputFile(path):
+# The process umask, so that files we create get normal permissions.
+_umask = os.umask(0)
+os.umask(_umask)
+
+class OutputWriter:
     """
-    Ensure all the dirs exist to be able to create a file, and
-    remove the file if it exists to allow it to be created.
+    Writes generated files.  A file whose contents wouldn't change isn't
+    touched at all, so its mtime is preserved.  Changed files are written
+    to a temp file and renamed into place, so a file is never seen half
+    written.
     """
-    dirs = os.path.split(path)[0]
-    if dirs:
-        if not os.access(dirs, os.F_OK):
+    def __init__(self):
+        self.knownDirs = set()
+        self.nwritten = 0
+        self.nunchanged = 0
+        self.lock = threading.Lock()
+
+    def ensureDir(self, dirs):
+        """Make sure the directory `dirs` exists."""
+        if dirs and dirs not in self.knownDirs:
             makedirs(dirs)
-    if os.access(path, os.F_OK):
-        if _verbose > 1: print("rm", path)
-        os.remove(path)
-    if _verbose > 0: print("writing", path)
-
-class MyXslt:
-
-    class OneCache:
-        def __init__(self):
-            self.key = ''
-            self.value = None
-
-        def get(self, key):
-            if key == self.key:
-                return self.value
-            else:
-                return None
-
-        def put(self, key, value):
-            self.key = key
-            self.value = value
-
-    class ManyCache:
-        def __init__(self):
-            self.cache = {}
+            self.knownDirs.add(dirs)
 
-        def get(self, key):
-            if key in self.cache:
-                return self.cache[key]
-            else:
-                return None
+    def forgetDirs(self, path=None):
+        """
+        The directory `path` may have been removed: forget that it and the
+        directories below it exist.  With no `path`, forget them all.
+        """
+        with self.lock:
+            if path is None:
+                self.knownDirs = set()
+                return
+            path = os.path.abspath(path)
+            below = path + os.sep
+            self.knownDirs = set(
+                d for d in self.knownDirs
+                if os.path.abspath(d) != path and not os.path.abspath(d).startswith(below)
+                )
+
+    def isSame(self, path, data):
+        """Does the file at `path` already contain exactly `data`?"""
+        try:
+            if os.stat(path).st_size != len(data):
+                return False
+            with open(path, "rb") as f:
+                return f.read() == data
+        except OSError:
+            return False
+
+    def write(self, path, data):
+        """
+        Write the bytes `data` to the file `path`, if they are different
+        than what is there now.  Returns True if the file was written.
+        """
+        with XuffTrace.span('write', 'io', path=path):
+            if self.isSame(path, data):
+                if _verbose > 1: print("unchanged", path)
+                with self.lock:
+                    self.nunchanged += 1
+                return False
+
+            dirs = os.path.dirname(path)
+            self.ensureDir(dirs)
+            XuffIndex.index.invalidate(path)
+            if _verbose > 0: print("writing", path)
+            fd, tmppath = tempfile.mkstemp(dir=dirs or '.', prefix='.xuff-', suffix='.tmp')
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.chmod(tmppath, 0o666 & ~_umask)
+                os.replace(tmppath, path)
+            except:
+                os.remove(tmppath)
+                raise
+            with self.lock:
+                self.nwritten += 1
+            return True
+
+    def copy(self, src, dst):
+        """Copy the file `src` to `dst`, if `dst` is different."""
+        with XuffTrace.span('copy', 'io', src=src, dst=dst):
+            with open(src, "rb") as f:
+                return self.write(dst, f.read())
+
+    def report(self):
+        return "%d files written, %d unchanged" % (self.nwritten, self.nunchanged)
+
+    def takeCounters(self):
+        with self.lock:
+            counters = (self.nwritten, self.nunchanged)
+            self.nwritten = self.nunchanged = 0
+        return counters
+
+    def addCounters(self, counters):
+        nwritten, nunchanged = counters
+        with self.lock:
+            self.nwritten += nwritten
+            self.nunchanged += nunchanged
+
+output = OutputWriter()
 
-        def put(self, key, value):
-            self.cache[key] = value
+class MyXslt:
 
     def __init__(self, styf):
         """Create an XSLT transformer based on the XSLT stylesheet at `styf` (a file path)."""
-        self.xmlCache = self.OneCache()
         self.styf = styf
-        self.xslt = etree.XSLT(etree.parse(self.styf))
-
-    def transformFile(self, inf, outf, params=None, moreParams=None):
-        """Transform file `inf` to `outf`.
-        
-        `inf` and `outf` are file paths.
-
-        """
-
-        #print("Transforming %s with %s to %s" % (inf, styf, outf))
-        prepareForOutputFile(outf)
-
+        compiled = XuffCache.stylesheets.get(styf)
+        self.closure = compiled.closure
+        self.resolver = compiled.resolver
+        self.xslt = compiled.xslt
+        self.stripsSpace = compiled.stripsSpace
+        self.loaded = set()
+
+    @staticmethod
+    def xsltParams(params=None, moreParams=None):
+        """Combine the `params` and `moreParams` dicts into the params for a transform."""
         xslt_params = {}
         if params:
             xslt_params.update(params)
             if moreParams:
                 xslt_params.update(moreParams)
+        return xslt_params
 
-        try:
-            xml = self.xmlCache.get(inf)
-            if xml is None:
-                xml = etree.parse(inf)
-                self.xmlCache.put(inf, xml)
+    def transformFile(self, inf, outf, params=None, moreParams=None, xml=None):
+        """Transform file `inf` to `outf`.
+        
+        `inf` and `outf` are file paths.  Afterwards, `self.loaded` is the
+        set of files read with document() during the transform.
 
-            out = str(self.xslt(xml, **xslt_params))
-        except:
-            import traceback
-            traceback.print_exc()
-            etype, evalue = sys.exc_info()[:2]
-            raise XuffError("XSL error: %s: %s (%s %s)" % (etype, evalue, inf, self.styf))
+        If `xml` is an already-parsed tree, it is transformed instead of
+        reading `inf`, which is then only used to name the input, and
+        may be changed by the transform.  A tree from the document cache is
+        copied first if the stylesheet strips whitespace, since libxslt does
+        that to the input tree itself.
+
+        """
 
-        out_file = open(outf, "w")
-        out_file.write(out)
-        out_file.close()
+        #print("Transforming %s with %s to %s" % (inf, styf, outf))
+        with XuffTrace.span('transform', 'xslt', inf=inf, outf=outf):
+            xslt_params = self.xsltParams(params, moreParams)
+
+            try:
+                if xml is None:
+                    xml = XuffCache.documents.parse(inf)
+                    if self.stripsSpace:
+                        xml = copy.deepcopy(xml)
+                self.resolver.loaded = set()
+                out = bytes(self.xslt(xml, **xslt_params))
+            except:
+                import traceback
+                traceback.print_exc()
+                etype, evalue = sys.exc_info()[:2]
+                raise XuffError("XSL error: %s: %s (%s %s)" % (etype, evalue, inf, self.styf))
+            finally:
+                self.loaded = self.resolver.loaded or set()
+                self.resolver.loaded = None
+
+            output.write(outf, out)
+
+def xpathValue(value):
+    """
+    Convert an XPath result to what it would be as an argument to an
+    extension function given the same expression with string() around it,
+    keeping booleans and numbers as they are.
+    """
+    if isinstance(value, list):
+        if not value:
+            return ''
+        value = value[0]
+        if hasattr(value, 'itertext'):
+            return ''.join(value.itertext())
+    if isinstance(value, str):
+        return str(value)
+    return value
 
 def parse_xml(xmlfile):
     try:
@@ -156,7 +277,7 @@ class TreeFileWalker(walk.DirWalker):
     Our specialization of DirWalker
     """
     def __init__(self, dstf):
-        walk.DirWalker.__init__(self)
+        walk.DirWalker.__init__(self, XuffIndex.index)
         self.dstf = dstf
 
     def startDir(self, dirName, dirPath):
@@ -168,10 +289,11 @@ class TreeFileWalker(walk.DirWalker):
 
     def file(self, fileName, path, patIndex):
         if patIndex == 0:
+            realpath = self.realPath(path)
             path = path.replace('\\', '/')
             print("<file name='%s' path='%s'>" % (fileName, path), file=self.dstf)
             # open the file
-            f = open(path)
+            f = open(realpath)
             l1 = f.readline().strip()
             # Only output the first line if it is not an XML declaration.
             #if not (l1.find("<?xml ") != -1 and l1.endswith("?>")):
@@ -185,20 +307,86 @@ class TreeFileWalker(walk.DirWalker):
         elif patIndex == 1:
             print("<file name='%s'/>" % fileName, file=self.dstf)
 
+class TreeBuilderWalker(walk.DirWalker):
+    """
+    Like TreeFileWalker, but builds the model of the tree in memory, as
+    lxml elements appended to `root`.  The newlines TreeFileWalker writes
+    after each tag are added as text too, so the tree is the same as
+    parsing TreeFileWalker's file: text nodes and node() positions match.
+    """
+    def __init__(self, root):
+        walk.DirWalker.__init__(self, XuffIndex.index)
+        if root.text is None:
+            root.text = "\n"
+        self.stack = [root]
+
+    def startDir(self, dirName, dirPath):
+        dirPath = dirPath.replace('\\', '/')
+        dirElt = etree.SubElement(self.stack[-1], 'directory', name=dirName, path=dirPath)
+        dirElt.text = dirElt.tail = "\n"
+        self.stack.append(dirElt)
+
+    def endDir(self, dirName, dirPath):
+        self.stack.pop()
+
+    def file(self, fileName, path, patIndex):
+        if patIndex == 0:
+            realpath = self.realPath(path)
+            path = path.replace('\\', '/')
+            with open(realpath, 'rb') as f:
+                l1 = f.readline().strip()
+                rest = f.read()
+            # Drop an XML declaration on the first line, as TreeFileWalker does.
+            if l1.find(b"<?xml ") != -1:
+                l1 = l1[l1.find(b"?>")+2:]
+            try:
+                fileElt = etree.fromstring(b"<file>\n" + l1 + rest + b"</file>")
+            except etree.XMLSyntaxError as e:
+                raise XuffError("Couldn't parse %s: %s" % (path, e))
+            fileElt.set('name', fileName)
+            fileElt.set('path', path)
+            fileElt.tail = "\n"
+            self.stack[-1].append(fileElt)
+        elif patIndex == 1:
+            etree.SubElement(self.stack[-1], 'file', name=fileName).tail = "\n"
+
 class XslTreeWalker(walk.DirWalker):
     """
     Specialization of DirWalker for transforming trees of files.
+
+    If `deps` is a XuffDeps.DepFile, outputs that are up-to-date with
+    their recorded dependencies are skipped.
+
+    If `jobs` is more than 1, the walk only collects the files to transform,
+    and `finish` transforms them in that many worker processes.
+
+    If `only` is a set of absolute paths, other source files are ignored.
     """
-    def __init__(self, styf, dstpath, userXslParams):
-        walk.DirWalker.__init__(self)
-        self.myxslt = MyXslt(styf)
+    def __init__(self, styf, dstpath, userXslParams, deps=None, jobs=1, only=None):
+        walk.DirWalker.__init__(self, XuffIndex.index)
+        self.styf = styf
         self.dstpath = os.path.abspath(dstpath)
         self.userXslParams = userXslParams
+        self.deps = deps
+        self.jobs = jobs
+        self.only = only
+        self.ext = None
+        self.tasks = []
+        self.loaded = set()
+        if self.jobs > 1:
+            self.myxslt = None
+            self.closure = XuffDeps.stylesheetClosure(styf)
+        else:
+            self.myxslt = MyXslt(styf)
+            self.closure = self.myxslt.closure
 
     def forceExtension(self, ext):
         self.ext = ext
 
     def file(self, fileName, path, patIndex):
+        inf = os.path.abspath(self.realPath(path))
+        if self.only is not None and inf not in self.only:
+            return
         dpath = path
         if self.ext:
             dpath = dpath[:dpath.rfind('.')] + self.ext
@@ -207,55 +395,550 @@ class XslTreeWalker(walk.DirWalker):
             'dpath':    '"' + dpath.replace('\\', '/') + '"'
             }
         dpath = os.path.join(self.dstpath, dpath)
-        self.myxslt.transformFile(path, dpath, self.userXslParams, moreParams)
+        if self.deps is not None:
+            xslt_params = MyXslt.xsltParams(self.userXslParams, moreParams)
+            if self.deps.isCurrent(dpath, xslt_params):
+                if _verbose > 1: print("up-to-date", dpath)
+                self.deps.nskipped += 1
+                return
+
+        if self.jobs > 1:
+            self.tasks.append((inf, dpath, moreParams))
+        else:
+            self.myxslt.transformFile(inf, dpath, self.userXslParams, moreParams)
+            self.built(inf, dpath, moreParams, self.myxslt.loaded)
+
+    def built(self, inf, outf, moreParams, loaded):
+        """Record the dependencies of a freshly built `outf`."""
+        self.loaded.update(loaded)
+        if self.deps is not None:
+            xslt_params = MyXslt.xsltParams(self.userXslParams, moreParams)
+            self.deps.record(outf, xslt_params, [inf] + self.closure + sorted(loaded))
+            self.deps.nbuilt += 1
+
+    def finish(self):
+        """
+        Transform the files collected by a parallel walk.
+        """
+        if not self.tasks:
+            return
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.jobs,
+            mp_context=_workerContext(),
+            initializer=_initXsltWorker,
+            initargs=(
+                self.styf, _verbose, XuffTrace.tracer.isTracing(), extStats is not None,
+                cacheSettings(), XuffCache.documents.budget,
+                ),
+            )
+        try:
+            futures = {}
+            for inf, outf, moreParams in self.tasks:
+                fut = pool.submit(_transformInWorker, inf, outf, self.userXslParams, moreParams)
+                futures[fut] = (inf, outf, moreParams)
+            for fut in concurrent.futures.as_completed(futures):
+                inf, outf, moreParams = futures[fut]
+                try:
+                    loaded, events, stats, cacheUpdates = fut.result()
+                except XuffError:
+                    raise
+                except Exception as e:
+                    raise XuffError("XSL error: %s: %s (%s %s)" % (type(e), e, inf, self.styf))
+                # The worker wrote outf, so our index has to hear about it.
+                XuffIndex.index.invalidate(outf)
+                self.built(inf, outf, moreParams, loaded)
+                for event in events:
+                    XuffTrace.tracer.add(event)
+                if stats:
+                    extStats.merge(stats)
+                addCacheUpdates(cacheUpdates)
+                for name, counters in cacheUpdates['memo'].items():
+                    memos[name].addCounters(counters)
+                output.addCounters(cacheUpdates['output'])
+                XuffCache.stylesheets.addCounters(cacheUpdates['stylesheets'])
+                XuffCache.documents.addCounters(cacheUpdates['documents'])
+        finally:
+            pool.shutdown(cancel_futures=True)
+        self.tasks = []
+
+def _workerContext():
+    """
+    How to start worker processes.  Forking a process that has other threads
+    running (xuff -p) can copy a lock some thread is holding, so start them
+    from a fork server instead.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+# State for XslTreeWalker worker processes: each compiles the stylesheet once.
+_workerXslt = None
+
+def _initXsltWorker(styf, verbose, tracing, stats, caches, docBudget):
+    global _workerXslt, _verbose, extStats
+    _verbose = verbose
+    configureCaches(**caches)
+    XuffCache.documents.setBudget(docBudget)
+    if tracing:
+        XuffTrace.tracer.start()
+    if stats:
+        extStats = ExtensionStats()
+    registerExtensions()
+    _workerXslt = MyXslt(styf)
+
+def _transformInWorker(inf, outf, params, moreParams):
+    """
+    Returns the files read with document(), the trace events, the extension
+    stats, and what the caches learned, with this worker's counters for the
+    -t report: the extension caches, memos, output, stylesheets and documents.
+    """
+    _workerXslt.transformFile(inf, outf, params, moreParams)
+    events = []
+    if XuffTrace.tracer.isTracing():
+        events = XuffTrace.tracer.takeEvents()
+    stats = None
+    if extStats is not None:
+        stats = extStats.take()
+    cacheUpdates = takeCacheUpdates()
+    cacheUpdates['memo'] = dict((name, memo.takeCounters()) for name, memo in memos.items())
+    cacheUpdates['output'] = output.takeCounters()
+    cacheUpdates['stylesheets'] = XuffCache.stylesheets.takeCounters()
+    cacheUpdates['documents'] = XuffCache.documents.takeCounters()
+    return _workerXslt.loaded, events, stats, cacheUpdates
+
+def _prerenderInWorker(kind, args):
+    """
+    Render for the prerender step.  Failures are left for the real call
+    in the transform to report, with better context.
+    """
+    try:
+        return prerender(kind, args)
+    except Exception:
+        return kind, None, None
+
+class FileListWalker(walk.DirWalker):
+    """
+    Specialization of DirWalker that just collects the paths of files.
+    """
+    def __init__(self):
+        walk.DirWalker.__init__(self, XuffIndex.index)
+        self.files = []
+
+    def file(self, fileName, path, patIndex):
+        self.files.append(self.realPath(path))
+
+# The ioctl to reflink one file to another on Linux.
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """
+    Make `dst` a copy-on-write clone of `src`, sharing its data.  Raises
+    OSError if the platform or filesystem can't.
+    """
+    if fcntl is None:
+        raise OSError("No reflinks on this platform")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def humanBytes(n):
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if n < 1024 or unit == 'GB':
+            break
+        n /= 1024
+    return ("%d %s" if unit == 'bytes' else "%.1f %s") % (n, unit)
+
+class FileCopier:
+    """
+    Copies files, skipping those whose copy is already current: the same
+    size and mtime, or with `verify`, the same contents.  Copies get their
+    source's mtime, so the next run can tell that they're current.  Where
+    the filesystem can, a copy is a reflink sharing the source's data, or
+    with `hardlink`, a hard link to the source.
+    """
+    def __init__(self, verify=False, hardlink=False):
+        self.verify = verify
+        self.hardlink = hardlink
+        self.canReflink = fcntl is not None
+        self.ncopied = 0
+        self.nskipped = 0
+        self.bytesCopied = 0
+        self.bytesSkipped = 0
+        self.lock = threading.Lock()
+
+    def isCurrent(self, src, srcStat, dst):
+        try:
+            dstStat = os.stat(dst)
+        except OSError:
+            return False
+        if dstStat.st_size != srcStat.st_size:
+            return False
+        if os.path.samestat(srcStat, dstStat):
+            return True
+        if self.verify:
+            if not filecmp.cmp(src, dst, shallow=False):
+                return False
+            if dstStat.st_mtime_ns != srcStat.st_mtime_ns:
+                os.utime(dst, ns=(srcStat.st_atime_ns, srcStat.st_mtime_ns))
+            return True
+        return dstStat.st_mtime_ns == srcStat.st_mtime_ns
+
+    def copy(self, src, dst):
+        """Copy the file `src` to `dst`, unless it's current.  Returns True if copied."""
+        with XuffTrace.span('copy', 'io', src=src, dst=dst):
+            srcStat = os.stat(src)
+            if self.isCurrent(src, srcStat, dst):
+                if _verbose > 1: print("unchanged", dst)
+                with self.lock:
+                    self.nskipped += 1
+                    self.bytesSkipped += srcStat.st_size
+                return False
+
+            dirs = os.path.dirname(dst)
+            output.ensureDir(dirs)
+            XuffIndex.index.invalidate(dst)
+            if _verbose > 0: print("copying", dst)
+            # Copy to a temp file and rename it into place, like OutputWriter.
+            tmppath = os.path.join(dirs, ".xuff-%d-%d.tmp" % (os.getpid(), threading.get_ident()))
+            try:
+                if not (self.hardlink and self.link(src, tmppath)):
+                    self.copyData(src, tmppath)
+                    os.chmod(tmppath, 0o666 & ~_umask)
+                    os.utime(tmppath, ns=(srcStat.st_atime_ns, srcStat.st_mtime_ns))
+                os.replace(tmppath, dst)
+            except:
+                if os.path.lexists(tmppath):
+                    os.remove(tmppath)
+                raise
+            with self.lock:
+                self.ncopied += 1
+                self.bytesCopied += srcStat.st_size
+            return True
+
+    def link(self, src, dst):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            return False
+
+    def copyData(self, src, dst):
+        if self.canReflink:
+            try:
+                reflink(src, dst)
+                return
+            except OSError:
+                # Most likely the filesystem can't, so don't keep trying.
+                self.canReflink = False
+        shutil.copyfile(src, dst)
+
+    def copyAll(self, pairs, jobs=1):
+        """Copy each (src, dst) in `pairs`, using up to `jobs` threads."""
+        if jobs > 1 and len(pairs) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                for _ in pool.map(lambda pair: self.copy(*pair), pairs):
+                    pass
+        else:
+            for src, dst in pairs:
+                self.copy(src, dst)
+
+    def report(self):
+        return "%d copied (%s), %d skipped (%s)" % (
+            self.ncopied, humanBytes(self.bytesCopied),
+            self.nskipped, humanBytes(self.bytesSkipped),
+            )
 
 class CopyFilesWalker(walk.DirWalker):
     """
-    Specialization of DirWalker for copying trees of files.
+    Specialization of DirWalker for copying trees of files: collects
+    the (src, dst) pairs to copy.
     """
     def __init__(self, dstpath):
-        walk.DirWalker.__init__(self)
+        walk.DirWalker.__init__(self, XuffIndex.index)
         self.dstpath = os.path.abspath(dstpath)
+        self.files = []
 
     def file(self, fileName, path, patIndex):
-        dpath = os.path.join(self.dstpath, path)
-        prepareForOutputFile(dpath)
-        shutil.copyfile(path, dpath)
+        self.files.append((self.realPath(path), os.path.join(self.dstpath, path)))
 
-class FileSplitter(handler.ContentHandler):
+class FileSplitter:
+    """
+    Splits an XML file into many, as directed by its <directory> and <file>
+    elements: the content of each <file> becomes a file, written only if it
+    changed.  The input is parsed incrementally, and each <file> is thrown
+    away once written, so even huge inputs take little memory.
+    """
     def __init__(self, dst='.'):
-        self.xmlgen = None
-        self.dirStack = [dst]
-
-    def startElement(self, name, attrs):
-        if name == 'directory':
-            self.dirStack.append(os.path.join(self.dirStack[-1], attrs['name']))
-        elif name == 'file':
-            fpath = os.path.join(self.dirStack[-1], attrs['name'])
-            prepareForOutputFile(fpath)
-            self.outf = open(fpath, 'w')
-            self.outf.write('<?xml version="1.0" encoding="utf-8"?>')
-            self.xmlgen = saxutils.XMLGenerator(self.outf, 'utf-8')
-        else:
-            self.xmlgen.startElement(name, attrs)
-
-    def endElement(self, name):
-        if name == 'directory':
-            self.dirStack = self.dirStack[:-1]
-        elif name == 'file':
-            self.xmlgen = None
-            self.outf.flush()
-            self.outf.close()
+        self.dst = dst
+        self.nfiles = 0
+
+    def split(self, inf):
+        dirStack = [self.dst]
+        fileElem = None
+        events = etree.iterparse(inf, events=('start', 'end'), remove_comments=True, remove_pis=True)
+        for event, elem in events:
+            if fileElem is not None:
+                # Inside a <file>: everything is content, until its end.
+                if event == 'end' and elem is fileElem:
+                    self.writeFile(os.path.join(dirStack[-1], elem.get('name')), elem)
+                    self.discard(elem)
+                    fileElem = None
+            elif event == 'start':
+                self.checkOrphan(elem)
+                # The stylesheet making the file may have put these elements
+                # in a default namespace: only the local name matters.
+                tag = etree.QName(elem).localname
+                if tag == 'directory':
+                    dirStack.append(os.path.join(dirStack[-1], elem.get('name')))
+                elif tag == 'file':
+                    fileElem = elem
+                else:
+                    raise XuffError("Element <%s> in splitfile %s must be in a <file>" % (tag, inf))
+            elif etree.QName(elem).localname == 'directory':
+                dirStack.pop()
+                if len(elem):
+                    self.orphan(elem[-1].tail)
+                else:
+                    self.orphan(elem.text)
+                self.discard(elem)
+
+    def writeFile(self, fpath, elem):
+        """Write the content of the <file> element `elem` to `fpath`."""
+        data = [b'<?xml version="1.0" encoding="utf-8"?>']
+        if elem.text:
+            data.append(saxutils.escape(elem.text).encode('utf-8'))
+        # Content in the <file>'s own default namespace is written without
+        # it, as if the namespace weren't there.
+        ns = etree.QName(elem).namespace
+        for child in elem:
+            for sub in child.iter(tag=etree.Element):
+                if ns and sub.prefix is None and etree.QName(sub).namespace == ns:
+                    sub.tag = etree.QName(sub).localname
+                # Empty elements are written <x></x>, not <x/>: the files are
+                # often HTML, where <script/> or <div/> isn't closed.
+                if sub.text is None and len(sub) == 0:
+                    sub.text = ''
+            if ns:
+                # A detached copy, so the ancestors' declaration is dropped.
+                child = copy.deepcopy(child)
+                etree.cleanup_namespaces(child)
+            data.append(etree.tostring(child, encoding='utf-8', xml_declaration=False))
+        output.write(fpath, b''.join(data))
+        self.nfiles += 1
+
+    def discard(self, elem):
+        """Free a finished element, and its finished siblings before it."""
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    def checkOrphan(self, elem):
+        """Complain about text just before `elem`."""
+        prev = elem.getprevious()
+        if prev is not None:
+            self.orphan(prev.tail)
+        elif elem.getparent() is not None:
+            self.orphan(elem.getparent().text)
+
+    def orphan(self, text):
+        if text and text.strip() != '':
+            print("Orphaned chars:", text)
+
+from .XsltExtensions import *
+
+def argSize(arg):
+    """Roughly how many characters of data an extension function argument holds."""
+    if isinstance(arg, str):
+        return len(arg)
+    elif isinstance(arg, list):
+        return sum(argSize(a) for a in arg)
+    elif hasattr(arg, 'itertext'):
+        return sum(len(t) for t in arg.itertext())
+    else:
+        return 0
+
+class ExtensionStats:
+    """
+    Call counts, timings and argument sizes for the XSLT extension functions.
+    """
+    def __init__(self):
+        # Maps function name to [array of call durations, total argument size].
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, secs, size):
+        with self.lock:
+            rec = self.calls.get(name)
+            if rec is None:
+                rec = self.calls[name] = [array.array('d'), 0]
+            rec[0].append(secs)
+            rec[1] += size
+
+    def take(self):
+        """Return the stats collected so far, and forget them."""
+        with self.lock:
+            calls, self.calls = self.calls, {}
+        return calls
+
+    def merge(self, calls):
+        """Add in the stats `take`n from another ExtensionStats."""
+        with self.lock:
+            for name, (times, size) in calls.items():
+                rec = self.calls.get(name)
+                if rec is None:
+                    rec = self.calls[name] = [array.array('d'), 0]
+                rec[0].extend(times)
+                rec[1] += size
+
+    def summary(self):
+        """A list of dicts of stats, one per function, slowest total first."""
+        rows = []
+        for name, (times, size) in self.calls.items():
+            n = len(times)
+            ordered = sorted(times)
+            total = sum(ordered)
+            rows.append({
+                'name': name,
+                'calls': n,
+                'total': total,
+                'mean': total / n,
+                'p95': ordered[max(0, int(math.ceil(0.95 * n)) - 1)],
+                'argchars': size,
+                })
+        rows.sort(key=lambda r: r['total'], reverse=True)
+        return rows
+
+    def show(self):
+        print("%-14s %9s %10s %10s %10s %12s" % ("extension", "calls", "total s", "mean ms", "p95 ms", "arg chars"))
+        for r in self.summary():
+            print("%-14s %9d %10.3f %10.3f %10.3f %12d" % (
+                r['name'], r['calls'], r['total'], r['mean']*1000, r['p95']*1000, r['argchars']
+                ))
+
+    def writeJson(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+# If not None, an ExtensionStats collecting stats about extension calls.
+extStats = None
+
+def memoKey(args):
+    """
+    Make a memo key from extension function arguments, or return None if
+    they can't be a key.  Strings from XPath are converted to plain strings,
+    so the memo doesn't keep their documents alive.
+    """
+    key = []
+    for arg in args:
+        if isinstance(arg, str):
+            key.append(str(arg))
+        elif arg is None or isinstance(arg, (bool, int, float)):
+            key.append(arg)
         else:
-            self.xmlgen.endElement(name)
+            # Node-sets and such: not worth memoizing.
+            return None
+    return tuple(key)
 
-    def characters(self, content):
-        if self.xmlgen:
-            self.xmlgen.characters(content)
-        elif content.strip() != '':
-            print("Orphaned chars:", content)
+class PureMemo:
+    """
+    Remembers the results of a pure extension function `fn`, keeping the
+    `maxsize` most recently used.
+    """
+    def __init__(self, fn, maxsize=10000):
+        self.fn = fn
+        self.maxsize = maxsize
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *args):
+        key = memoKey(args)
+        if key is None:
+            return self.fn(*args)
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return self.results[key]
+        result = self.fn(*key)
+        with self.lock:
+            self.misses += 1
+            self.results[key] = result
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+        return result
+
+    def takeCounters(self):
+        with self.lock:
+            counters = (self.hits, self.misses)
+            self.hits = self.misses = 0
+        return counters
+
+    def addCounters(self, counters):
+        with self.lock:
+            self.hits += counters[0]
+            self.misses += counters[1]
+
+# The PureMemo for each pure extension function, by name.
+memos = {}
+
+def memoReport():
+    parts = []
+    for name, memo in sorted(memos.items()):
+        if memo.hits or memo.misses:
+            parts.append("%s %d/%d" % (name, memo.hits, memo.hits + memo.misses))
+    return "memo hits: " + (", ".join(parts) or "none")
+
+def registerExtensions():
+    """
+    Register our XSLT extension functions with lxml.  Every process that
+    runs transforms has to do this.
+    """
+    def wrapit(name, fn, pure):
+        """ lxml extensions have a first dummy arg that Pyana extensions don't.  Adapt.
 
-from .XsltExtensions import *
+        Pure functions, whose result depends only on their arguments, are
+        memoized.
+        """
+        if pure:
+            fn = memos[name] = PureMemo(fn)
+
+        def inside(dummy, *args):
+            try:
+                if extStats is None:
+                    return fn(*args)
+                start = time.perf_counter()
+                try:
+                    return fn(*args)
+                finally:
+                    extStats.record(name, time.perf_counter() - start, argSize(list(args)))
+            except Exception as e:
+                print("Error in XSLT extension: %s" % e)
+                raise
+        return inside
+
+    # lexcode and markdown have their own caches, and imgwidth and imgheight
+    # depend on the image files, so they aren't declared pure.
+    extensions = [
+        # name,         function,               pure
+        ('endswith',    endswith,               True),
+        ('makeuri',     makeuri,                True),
+        ('urlquote',    urlquote,               True),
+        ('phpquote',    phpquote,               True),
+        ('now',         now8601,                False),
+        ('w3cdtf',      w3cdtf,                 True),
+        ('idfromtext',  idfromtext,             True),
+        ('slugfromtext', slugfromtext,          True),
+        ('lexcode',     lexcode,                False),
+        ('markdown',    markdown,               False),
+        ('imgwidth',    imgwidth,               False),
+        ('imgheight',   imgheight,              False),
+        ('smartypants', smartypants.smartypants, True),
+        ]
+
+    ns = etree.FunctionNamespace(XuffApp.XuffNamespaceUri)
+    for name, fn, pure in extensions:
+        ns[name] = wrapit(name, fn, pure)
 
 ##
 ##  The XuffApp
@@ -266,7 +949,13 @@ class XuffApp:
 
     def __init__(self):
         self.userXslParams = {}
+        self.trees = {}
         self.timing = 0
+        self.stepLog = None
+        self.loaded = set()
+        self.onlyFiles = None
+        self.jobs = 1
+        self.stepJobs = 1
 
     def main(self, argv):
         """
@@ -275,21 +964,41 @@ class XuffApp:
         import getopt
 
         def usage():
-            print("xuff [-t] [-v[v]] xuff-files ...")
+            print("xuff [-t] [-v[v]] [-j jobs] [-p steps] [--watch] [--trace out.json]")
+            print("     [--extstats] [--extstats-json out.json] [--docbudget MB] xuff-files ...")
 
         # Parse arguments.
         try:
-            opts, args = getopt.getopt(argv[1:], "tv")
+            opts, args = getopt.getopt(argv[1:], "tvj:p:", ["watch", "trace=", "extstats", "extstats-json=", "docbudget="])
         except getopt.GetoptError:
             usage()
             return
 
+        watch = False
+        traceFile = None
+        extStatsFile = None
         for o, a in opts:
             if o == '-v':
                 global _verbose
                 _verbose += 1
             elif o == '-t':
                 self.timing += 1
+            elif o == '-j':
+                self.jobs = int(a)
+            elif o == '-p':
+                self.stepJobs = int(a)
+            elif o == '--docbudget':
+                XuffCache.documents.setBudget(int(a) * XuffCache.MB)
+            elif o == '--watch':
+                watch = True
+            elif o == '--trace':
+                traceFile = a
+                XuffTrace.tracer.start()
+            elif o in ('--extstats', '--extstats-json'):
+                global extStats
+                extStats = ExtensionStats()
+                if a:
+                    extStatsFile = a
             else:
                 usage()
                 return
@@ -301,36 +1010,37 @@ class XuffApp:
         logging.getLogger().setLevel(logging.INFO)
 
         # Init our XSLT extensions.
-        def wrapit(fn):
-            """ lxml extensions have a first dummy arg that Pyana extensions don't.  Adapt.
-            """
-            def inside(dummy, *args):
-                try:
-                    return fn(*args)
-                except Exception as e:
-                    print("Error in XSLT extension: %s" % e)
-                    raise
-            return inside
-
-        ns = etree.FunctionNamespace(self.XuffNamespaceUri)
-        ns['endswith'] = wrapit(endswith)
-        ns['makeuri'] = wrapit(makeuri)
-        ns['urlquote'] = wrapit(urlquote)
-        ns['phpquote'] = wrapit(phpquote)
-        ns['now'] = wrapit(now8601)
-        ns['w3cdtf'] = wrapit(w3cdtf)
-        ns['idfromtext'] = wrapit(idfromtext)
-        ns['slugfromtext'] = wrapit(slugfromtext)
-        ns['lexcode'] = wrapit(lexcode)
-        ns['markdown'] = wrapit(markdown)
-        ns['imgwidth'] = wrapit(imgwidth)
-        ns['imgheight'] = wrapit(imgheight)
-        ns['smartypants'] = wrapit(smartypants.smartypants)
+        registerExtensions()
 
         # Execute all the files.
         #try:
-        for a in args:
-            self.processFile(a)
+        if watch:
+            from . import XuffWatch
+            XuffWatch.Watcher(self, args).run()
+        else:
+            for a in args:
+                self.processFile(a)
+
+        if self.timing:
+            print("Cache: %s" % XuffCache.stylesheets.report())
+            print("Cache: %s" % XuffCache.documents.report())
+            print("Cache: %s" % lexcodeCache.report())
+            print("Cache: %s" % markdownCache.report())
+            print("Cache: %s" % imgsizecache.report())
+            print("Cache: %s" % memoReport())
+            print("Output: %s" % output.report())
+            print("Index: %s" % XuffIndex.index.report())
+
+        saveCaches()
+
+        if traceFile:
+            XuffTrace.tracer.write(traceFile)
+
+        if extStats is not None:
+            if extStatsFile:
+                extStats.writeJson(extStatsFile)
+            else:
+                extStats.show()
         #except XuffError as msg:
         #    print("*** %s" % msg)
 
@@ -350,25 +1060,98 @@ class XuffApp:
         Process a single xuff file
         """
         xml = parse_xml(fname)
-        for e in xml:
-            if self.isXuffElement(e):
-                handler = None
-                try:
-                    handler = getattr(self, 'handle_' + self.local_name(e))
-                except AttributeError:
-                    self.error("Didn't understand %s instruction" % (e.tag))
-
-                if handler:
-                    global _verbose
-                    doVerbose = self.getAttr(e, 'verbose', 'unchanged')
-                    oldVerbose = _verbose
-                    if doVerbose != 'unchanged':
-                        _verbose = doVerbose.lower() in ['1', 'true', 't', 'on', 'yes', 'y']
-                    timer = Timer()
-                    handler(e)
-                    if self.timing:
-                        timer.show("<%10s>" % e.tag)
-                    _verbose = oldVerbose
+        steps = [e for e in xml if self.isXuffElement(e)]
+        if self.stepJobs > 1 and self.stepLog is None:
+            # Steps that change the verbosity change it for everyone: run them alone.
+            ios = [self.schedIO(e) if e.get('verbose') is None else None for e in steps]
+            XuffSched.runSteps(self.runStep, steps, ios, self.stepJobs)
+        else:
+            for e in steps:
+                self.runStep(e)
+
+    def runStep(self, e):
+        """
+        Execute one xuff element.
+        """
+        handler = None
+        try:
+            handler = getattr(self, 'handle_' + self.local_name(e))
+        except AttributeError:
+            self.error("Didn't understand %s instruction" % (e.tag))
+
+        if handler:
+            global _verbose
+            doVerbose = self.getAttr(e, 'verbose', 'unchanged')
+            oldVerbose = _verbose
+            if doVerbose != 'unchanged':
+                _verbose = doVerbose.lower() in ['1', 'true', 't', 'on', 'yes', 'y']
+            timer = Timer()
+            self.loaded = set()
+            args = dict((k, v) for k, v in e.attrib.items() if k != 'password')
+            with XuffTrace.span(self.local_name(e), 'step', **args):
+                handler(e)
+            if self.stepLog is not None:
+                self.stepLog.append((e, self.loaded))
+            if self.timing:
+                timer.show("<%10s>" % e.tag)
+            _verbose = oldVerbose
+
+    def schedIO(self, e):
+        """
+        The (reads, writes, readsMore) triple for scheduling the step `e`,
+        or None.  XSLT steps get readsMore: their stylesheets can read
+        other files with document(), which their attributes don't name.
+        """
+        io = self.stepIO(e)
+        if io is None:
+            return None
+        reads, writes = io
+        return reads, writes, self.local_name(e) in ('xsl', 'xsltree')
+
+    def stepIO(self, e):
+        """
+        Determine what the step `e` reads and writes, from its attributes.
+
+        Returns a pair of lists, (reads, writes), of absolute paths (or
+        "mem:name" for trees kept in memory).  A directory stands for
+        everything beneath it.  Returns None if the step's effects can't
+        be known this way.
+        """
+        def path(p):
+            if p.startswith('mem:'):
+                return p
+            return os.path.abspath(p)
+
+        def style():
+            return XuffDeps.stylesheetClosure(e.get('style'))
+
+        name = self.local_name(e)
+        try:
+            if name == 'copy':
+                return [path(e.get('in'))], [path(e.get('out'))]
+            elif name == 'copytree':
+                return [path(e.get('src') or '.')], [path(e.get('dst'))]
+            elif name == 'xsl':
+                return [path(e.get('in'))] + style(), [path(e.get('out'))]
+            elif name == 'xsltree':
+                return [path(e.get('src') or '.')] + style(), [path(e.get('dst') or '.')]
+            elif name == 'treefile':
+                if e.get('src'):
+                    reads = [path(e.get('src'))]
+                else:
+                    reads = [path(e2.get('src')) for e2 in e if self.isXuffElement(e2)]
+                writes = []
+                if e.get('name'):
+                    writes.append('mem:' + e.get('name'))
+                if e.get('out') or not e.get('name'):
+                    writes.append(path(e.get('out') or 'tree.xml'))
+                return reads, writes
+            elif name == 'splitfile':
+                return [path(e.get('in'))], [path(e.get('dst') or '.')]
+        except (AttributeError, TypeError):
+            # A missing attribute: the handler will complain about it.
+            pass
+        return None
 
     def error(self, str):
         """
@@ -408,6 +1191,21 @@ class XuffApp:
         """
         pass
 
+    def handle_cache(self, e):
+        """
+        Keep the extension function caches in a directory between runs,
+        and/or set the memory budget in MB for parsed documents.
+        """
+        dirname = self.getAttrNullOk(e, 'dir')
+        docBudget = self.getAttrNullOk(e, 'docbudget')
+        if not dirname and not docBudget:
+            self.attrError(e, 'dir')
+        if dirname:
+            renderMax = int(self.getAttr(e, 'rendermax', '10000'))
+            configureCaches(os.path.abspath(dirname), renderMax)
+        if docBudget:
+            XuffCache.documents.setBudget(int(docBudget) * XuffCache.MB)
+
     def handle_message(self, e):
         """
         Write a message.
@@ -418,30 +1216,51 @@ class XuffApp:
     def handle_treefile(self, e):
         """
         Write a model of a tree as an XML file.
-        """
-        out = self.getAttr(e, 'out', 'tree.xml')
 
-        prepareForOutputFile(out)
-        outf = open(out, 'w')
-
-        print("<?xml version='1.0'?>", file=outf)
-        print("<tree>", file=outf)
+        With name=, the model is built in memory, and kept for <xsl in="mem:name">.
+        It's only written to a file if out= is also given.
+        """
+        name = self.getAttrNullOk(e, 'name')
+        if name:
+            out = self.getAttrNullOk(e, 'out')
+        else:
+            out = self.getAttr(e, 'out', 'tree.xml')
 
         if e.get('src'):
             # The element itself is the file spec.
-            self.doFilesForTreeFile(e, outf)
+            specs = [e]
         else:
             # Each <files> subelement is a file spec.
+            specs = []
             for e2 in e:
                 if self.isXuffElement(e2):
                     if self.local_name(e2) == 'files':
-                        self.doFilesForTreeFile(e2, outf)
+                        specs.append(e2)
                     else:
                         self.error("Didn't understand %s element" % (e2.tag))
 
+        if name:
+            root = etree.Element('tree')
+            for spec in specs:
+                self.doFilesForTreeFile(spec, TreeBuilderWalker(root))
+            tree = etree.ElementTree(root)
+            self.trees[name] = tree
+            if out:
+                output.write(out, etree.tostring(tree, xml_declaration=True, encoding='utf-8'))
+            return
+
+        outf = io.StringIO()
+
+        print("<?xml version='1.0'?>", file=outf)
+        print("<tree>", file=outf)
+
+        for spec in specs:
+            self.doFilesForTreeFile(spec, TreeFileWalker(outf))
+
         print("</tree>", file=outf)
+        output.write(out, outf.getvalue().encode('utf-8'))
 
-    def doFilesForTreeFile(self, e, outf):
+    def doFilesForTreeFile(self, e, walker):
         src = self.getAttr(e, 'src')
         inc = self.getAttrNullOk(e, 'include')
         mnt = self.getAttrNullOk(e, 'mention')
@@ -449,8 +1268,6 @@ class XuffApp:
         if (not inc) and (not mnt):
             mnt = '*'
 
-        walker = TreeFileWalker(outf)
-
         walker.setPattern(inc, 0)
         walker.setPattern(mnt, 1)
         walker.walk(src, '.', '.')
@@ -464,8 +1281,7 @@ class XuffApp:
         self.copyfile(inf, outf)
         
     def copyfile(self, src, dst):
-        prepareForOutputFile(dst)
-        shutil.copyfile(src, dst)
+        output.copy(src, dst)
 
     def handle_copytree(self, e):
         """
@@ -475,12 +1291,18 @@ class XuffApp:
         kw['src'] = self.getAttr(e, 'src', '.')
         kw['dst'] = self.getAttr(e, 'dst')
         kw['include'] = self.getAttr(e, 'include', '*.*')
+        kw['verify'] = self.getAttr(e, 'verify', 'no') == 'yes'
+        kw['hardlink'] = self.getAttr(e, 'hardlink', 'no') == 'yes'
+        kw['jobs'] = int(self.getAttr(e, 'jobs', str(max(self.jobs, COPY_JOBS))))
         self.copytree(**kw)
         
-    def copytree(self, dst, src='.', include='*.*'):
+    def copytree(self, dst, src='.', include='*.*', verify=False, hardlink=False, jobs=1):
         walker = CopyFilesWalker(dst)
         walker.setPattern(include, 0)
         walker.walk(src, '.', '.')
+        copier = FileCopier(verify, hardlink)
+        copier.copyAll(walker.files, jobs)
+        print("copytree %s: %s" % (src, copier.report()))
 
     def handle_xsl(self, e):
         """
@@ -499,8 +1321,18 @@ class XuffApp:
                 else:
                     self.error("Didn't understand <xsl> %s element" % (e2.tag))
 
+        xml = None
+        if inf.startswith('mem:'):
+            # A tree built in memory by <treefile name=...>.
+            xml = self.trees.get(inf[4:])
+            if xml is None:
+                self.error("No <treefile> named %r for <xsl in='%s'>" % (inf[4:], inf))
+            # Each transform gets its own copy, so none can change the kept tree.
+            xml = copy.deepcopy(xml)
+
         myxslt = MyXslt(os.path.abspath(styf))
-        myxslt.transformFile(inf, outf, self.userXslParams, dLocalParams)
+        myxslt.transformFile(inf, outf, self.userXslParams, dLocalParams, xml=xml)
+        self.loaded = myxslt.loaded
 
     def handle_xsltree(self, e):
         """
@@ -511,12 +1343,92 @@ class XuffApp:
         dst = self.getAttr(e, 'dst', '.')
         inc = self.getAttr(e, 'include', '*')
         ext = self.getAttrNullOk(e, 'outext')
+        depf = self.getAttrNullOk(e, 'deps')
+        jobs = int(self.getAttr(e, 'jobs', str(self.jobs)))
+
+        deps = None
+        if depf:
+            deps = XuffDeps.DepFile(os.path.abspath(depf))
 
-        walker = XslTreeWalker(os.path.abspath(styf), dst, self.userXslParams)
+        walker = XslTreeWalker(os.path.abspath(styf), dst, self.userXslParams, deps, jobs, self.onlyFiles)
         walker.setPattern(inc, 0)
         if ext:
             walker.forceExtension(ext)
         walker.walk(src, '.', '.')
+        walker.finish()
+        self.loaded = walker.loaded
+
+        if deps:
+            deps.write()
+            XuffIndex.index.invalidate(deps.fname)
+            print("xsltree %s: %d rebuilt, %d skipped" % (src, deps.nbuilt, deps.nskipped))
+
+    def handle_prerender(self, e):
+        """
+        Render the code and markdown in a tree of source files ahead of time,
+        in parallel, so the transforms that follow find the results cached.
+
+        Each <lexcode> or <markdown> subelement has a select= XPath for the
+        elements to render, and XPaths relative to them for the arguments
+        the stylesheets pass to xuff:lexcode (code=, lang=, number=) or
+        xuff:markdown (text=).
+
+        Without a <cache dir=...> before it, the results are only kept in
+        this process's memory, up to the rendermax limit: xsltree's worker
+        processes, and later runs, won't see them, so a warning is printed.
+        """
+        if not cacheSettings()['dirname']:
+            print("prerender: warning: no <cache dir=...>, so the results won't reach worker processes or later runs")
+        src = self.getAttr(e, 'src', '.')
+        inc = self.getAttr(e, 'include', '*')
+        jobs = int(self.getAttr(e, 'jobs', str(self.jobs if self.jobs > 1 else os.cpu_count() or 1)))
+
+        defaults = {
+            'lexcode': [('code', 'string(.)'), ('lang', 'string(@lang)'), ('number', 'false()')],
+            'markdown': [('text', 'string(.)')],
+            }
+        selectors = []
+        for e2 in e:
+            if self.isXuffElement(e2):
+                kind = self.local_name(e2)
+                if kind not in defaults:
+                    self.error("Didn't understand <prerender> %s element" % (e2.tag))
+                nsmap = dict((k, v) for k, v in e2.nsmap.items() if k)
+                select = etree.XPath(self.getAttr(e2, 'select'), namespaces=nsmap)
+                args = [etree.XPath(e2.get(name) or default, namespaces=nsmap) for name, default in defaults[kind]]
+                selectors.append((kind, select, args))
+
+        walker = FileListWalker()
+        walker.setPattern(inc, 0)
+        walker.walk(src, '.', '.')
+
+        # Collect the distinct things to render that aren't cached already.
+        todo = {}
+        for path in walker.files:
+            doc = XuffCache.documents.parse(path)
+            for kind, select, argPaths in selectors:
+                for elt in select(doc):
+                    args = [xpathValue(argPath(elt)) for argPath in argPaths]
+                    if kind == 'lexcode':
+                        args = lexcodeArgs(*args)
+                    cache = renderCaches[kind]
+                    key = cache.key(*args)
+                    if key not in todo and not cache.has(key):
+                        todo[key] = (kind, tuple(args))
+
+        nrendered = 0
+        if todo:
+            kinds = [kind for kind, args in todo.values()]
+            argss = [args for kind, args in todo.values()]
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=_workerContext()) as pool:
+                    for kind, key, html in pool.map(_prerenderInWorker, kinds, argss, chunksize=16):
+                        if html is not None:
+                            renderCaches[kind].put(key, html)
+                            nrendered += 1
+            except concurrent.futures.process.BrokenProcessPool as e:
+                raise XuffError("prerender workers failed: %s" % e)
+        print("prerender %s: %d rendered, %d files" % (src, nrendered, len(walker.files)))
 
     def handle_splitfile(self, e):
         """
@@ -525,9 +1437,7 @@ class XuffApp:
         inf = self.getAttr(e, 'in')
         dst = self.getAttr(e, 'dst', '.')
 
-        parser = make_parser()
-        parser.setContentHandler(FileSplitter(dst))
-        parser.parse(inf)
+        FileSplitter(dst).split(inf)
 
     def handle_param(self, e):
         """
@@ -543,6 +1453,8 @@ class XuffApp:
         if os.access(dst, os.F_OK):
             if _verbose > 0: print("del", dst)
             os.remove(dst)
+            XuffIndex.index.invalidateTree(dst)
+            output.forgetDirs(dst)
 
     def handle_rmdir(self, e):
         """
@@ -552,6 +1464,8 @@ class XuffApp:
         if os.access(dst, os.F_OK):
             if _verbose > 0: print("rmdir", dst)
             shutil.rmtree(dst)
+            XuffIndex.index.invalidateTree(dst)
+            output.forgetDirs(dst)
 
     def handle_xuff(self, e):
         """
@@ -577,25 +1491,31 @@ class XuffApp:
         kw['text'] = self.getAttr(e, 'text')
         kw['binary'] = self.getAttr(e, 'binary')
         kw['md5file'] = self.getAttrNullOk(e, 'md5')
+        kw['connections'] = int(self.getAttr(e, 'connections', '1'))
+        kw['verify'] = self.getAttr(e, 'verify', 'no') == 'yes'
+        kw['hashname'] = self.getAttr(e, 'hash', 'blake2b')
 
         self.upload(**kw)
         
-    def upload(self, host, user, password, hostdir, src, text, binary, md5file, only=None, skip=None):
+    def upload(self, host, user, password, hostdir, src, text, binary, md5file, only=None, skip=None, connections=1, verify=False, hashname='blake2b'):
         import blogtools.FtpUpload as FtpUpload
         import socket
 
-        fu = FtpUpload.FtpUpload()
+        fu = FtpUpload.FtpUpload(XuffIndex.index)
+        fu.setHashName(hashname)
         if md5file:
             fu.setMd5File(md5file)
-        fu.setHost(host, user, password)
+        fu.setHost(host, user, password, connections)
         try:
-            fu.upload(hostdir=hostdir, text=text, binary=binary, src=src, only=only, skip=skip)
+            fu.upload(hostdir=hostdir, text=text, binary=binary, src=src, only=only, skip=skip, verify=verify)
             if not only:
                 fu.deleteOldFiles()
         except Exception as msg:
             print("Error:", msg)
             raise
         fu.finish()
+        if md5file:
+            XuffIndex.index.invalidate(md5file)
 
     def handle_httpping(self, e):
         """
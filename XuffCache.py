@@ -0,0 +1,177 @@
+"""
+XuffCache
+
+Process-wide caches shared by all the steps in a xuff run.
+"""
+
+import collections
+import os
+import threading
+
+from lxml import etree
+
+from . import XuffDeps
+from . import XuffTrace
+
+class CompiledStylesheet:
+    """
+    A compiled stylesheet, with what we need to know to use and re-check it.
+    """
+    def __init__(self, styf):
+        self.styf = styf
+        self.closure = XuffDeps.stylesheetClosure(styf)
+        self.stripsSpace = XuffDeps.stripsSpace(self.closure)
+        self.stamps = [XuffDeps.fileStamp(f) for f in self.closure]
+        self.resolver = XuffDeps.RecordingResolver()
+        parser = etree.XMLParser()
+        parser.resolvers.add(self.resolver)
+        self.xslt = etree.XSLT(etree.parse(styf, parser))
+
+    def isCurrent(self):
+        """Are the stylesheet and all its includes unchanged since compiling?"""
+        return [XuffDeps.fileStamp(f) for f in self.closure] == self.stamps
+
+class StylesheetCache:
+    """
+    Compiled stylesheets, keyed by absolute path, and recompiled when any
+    file in the include/import closure changes.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, styf):
+        """Return a CompiledStylesheet for the stylesheet file `styf`."""
+        styf = os.path.abspath(styf)
+        with self.lock:
+            entry = self.entries.get(styf)
+            if entry is not None and entry.isCurrent():
+                self.hits += 1
+                return entry
+            self.misses += 1
+            entry = CompiledStylesheet(styf)
+            self.entries[styf] = entry
+            return entry
+
+    def report(self):
+        return "stylesheets: %d hits, %d misses" % (self.hits, self.misses)
+
+    def takeCounters(self):
+        with self.lock:
+            counters = (self.hits, self.misses)
+            self.hits = self.misses = 0
+        return counters
+
+    def addCounters(self, counters):
+        hits, misses = counters
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+stylesheets = StylesheetCache()
+
+MB = 1024 * 1024
+
+class DocumentCache:
+    """
+    Parsed XML documents, keyed by absolute path.  The least recently used
+    documents are dropped to keep the total under `budget` bytes, and a
+    document is re-parsed if its file's mtime or size changes.
+
+    The trees are shared by every step that reads the file, so they mustn't
+    be changed: a stylesheet with <xsl:strip-space> is given a copy.
+
+    The memory a tree takes is estimated as a multiple of its file size.
+    Documents too big for the budget on their own aren't kept at all, and
+    are counted in the report, so the budget can be raised with
+    <cache docbudget="MB"> or xuff --docbudget=MB.
+    """
+    TREE_BYTES_PER_FILE_BYTE = 8
+
+    def __init__(self, budget=256*MB):
+        self.budget = budget
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tooBig = {}
+        self.lock = threading.RLock()
+
+    def setBudget(self, budget):
+        """Keep the cached documents under `budget` bytes from now on."""
+        with self.lock:
+            self.budget = budget
+            self.trim()
+
+    def trim(self):
+        while self.size > self.budget:
+            oldpath = next(iter(self.entries))
+            self.discard(oldpath)
+            self.evictions += 1
+
+    def parse(self, fname):
+        """Return the parsed etree for the file `fname`."""
+        path = os.path.abspath(fname)
+        stamp = XuffDeps.fileStamp(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                if entry[0] == stamp:
+                    self.entries.move_to_end(path)
+                    self.hits += 1
+                    return entry[1]
+                self.discard(path)
+            self.misses += 1
+
+        # Parse outside the lock, so other threads aren't held up.
+        with XuffTrace.span('parse', 'parse', path=path):
+            tree = etree.parse(fname)
+        if stamp is not None:
+            size = stamp[1] * self.TREE_BYTES_PER_FILE_BYTE
+            with self.lock:
+                if size <= self.budget:
+                    self.discard(path)
+                    self.entries[path] = (stamp, tree, size)
+                    self.size += size
+                    self.trim()
+                else:
+                    self.tooBig[path] = size
+        return tree
+
+    def discard(self, path):
+        """Forget the document at `path`."""
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def report(self):
+        report = "documents: %d parses avoided, %d parsed, %d evicted" % (
+            self.hits, self.misses, self.evictions
+            )
+        if self.tooBig:
+            path, size = max(self.tooBig.items(), key=lambda item: item[1])
+            report += ", %d too big for the %d MB budget (%s needs ~%d MB)" % (
+                len(self.tooBig), self.budget // MB, os.path.basename(path), -(-size // MB)
+                )
+        return report
+
+    def takeCounters(self):
+        with self.lock:
+            counters = (self.hits, self.misses, self.evictions, self.tooBig)
+            self.hits = self.misses = self.evictions = 0
+            self.tooBig = {}
+        return counters
+
+    def addCounters(self, counters):
+        hits, misses, evictions, tooBig = counters
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+            self.tooBig.update(tooBig)
+
+documents = DocumentCache()
@@ -0,0 +1,162 @@
+"""
+XuffDeps
+
+Dependency tracking for incremental xuff builds.
+
+Each output file is recorded with the files it was built from (the
+source file, the stylesheet and everything it includes or imports, and
+any documents read with document()), along with the XSLT params used.
+On the next run, an output whose record still matches can be skipped.
+"""
+
+import json
+import os
+import re
+import threading
+import urllib.parse
+
+from lxml import etree
+
+XSL_NS = 'http://www.w3.org/1999/XSL/Transform'
+
+def fileStamp(path):
+    """
+    Return a JSON-friendly signature of the file at `path`, or None if
+    it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+def isUnder(path, top):
+    """Is `path` the same as `top`, or inside it?"""
+    return path == top or path.startswith(top.rstrip(os.sep) + os.sep)
+
+def overlaps(p1, p2):
+    """Does one of the paths `p1` and `p2` contain the other?"""
+    return isUnder(p1, p2) or isUnder(p2, p1)
+
+def urlToPath(url):
+    """
+    Turn a URL that libxml2 wants to load into a local file path, or None
+    if it isn't a local file.
+    """
+    if url.startswith('file:'):
+        url = urllib.parse.unquote(url[5:])
+        if url.startswith('///'):
+            url = url[2:]
+    elif re.match(r"^[a-zA-Z][-+.a-zA-Z0-9]+:", url):
+        # http:, ftp:, etc.  (A single letter is a Windows drive.)
+        return None
+    return os.path.abspath(url)
+
+def stylesheetClosure(styf):
+    """
+    Return a list of the absolute paths of the stylesheet `styf` and all
+    the stylesheets it includes or imports, recursively.
+    """
+    closure = []
+    todo = [os.path.abspath(styf)]
+    while todo:
+        f = todo.pop()
+        if f in closure:
+            continue
+        closure.append(f)
+        try:
+            doc = etree.parse(f)
+        except (OSError, etree.XMLSyntaxError):
+            continue
+        for e in doc.iter('{%s}include' % XSL_NS, '{%s}import' % XSL_NS):
+            href = e.get('href')
+            if href:
+                path = urlToPath(href if os.path.isabs(href) else os.path.join(os.path.dirname(f), href))
+                if path:
+                    todo.append(os.path.normpath(path))
+    return closure
+
+def stripsSpace(closure):
+    """
+    Does any stylesheet in `closure` have an <xsl:strip-space>?  libxslt
+    strips the whitespace from the input document itself, so such a
+    stylesheet changes the tree it's given.
+    """
+    for f in closure:
+        try:
+            doc = etree.parse(f)
+        except (OSError, etree.XMLSyntaxError):
+            continue
+        if doc.find('{%s}strip-space' % XSL_NS) is not None:
+            return True
+    return False
+
+class RecordingResolver(etree.Resolver):
+    """
+    A resolver that notes the files loaded through it, but lets libxml2
+    do the actual loading.  Attached to the parser of a stylesheet, it sees
+    the documents read by document() during a transform.
+
+    `loaded` is per-thread, since the stylesheet can be used by transforms
+    in more than one thread at once.
+    """
+    def __init__(self):
+        etree.Resolver.__init__(self)
+        self.local = threading.local()
+
+    @property
+    def loaded(self):
+        return getattr(self.local, 'loaded', None)
+
+    @loaded.setter
+    def loaded(self, value):
+        self.local.loaded = value
+
+    def resolve(self, url, pubid, context):
+        if self.loaded is not None and url:
+            path = urlToPath(url)
+            if path:
+                self.loaded.add(path)
+        return None
+
+class DepFile:
+    """
+    A persistent record of what each output file was built from.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.deps = {}
+        self.nbuilt = 0
+        self.nskipped = 0
+        try:
+            with open(self.fname) as f:
+                self.deps = json.load(f)
+        except (OSError, ValueError):
+            self.deps = {}
+
+    def isCurrent(self, outf, params):
+        """
+        Is `outf` up-to-date with respect to its recorded dependencies?
+        """
+        rec = self.deps.get(outf)
+        if rec is None or rec['params'] != params:
+            return False
+        if not os.path.exists(outf):
+            return False
+        for path, stamp in rec['files'].items():
+            if fileStamp(path) != stamp:
+                return False
+        return True
+
+    def record(self, outf, params, files):
+        """
+        Remember that `outf` was built from `files` with `params`.
+        """
+        self.deps[outf] = {
+            'params': params,
+            'files': dict((f, fileStamp(f)) for f in files),
+            }
+
+    def write(self):
+        with open(self.fname, 'w') as f:
+            json.dump(self.deps, f, indent=1, sort_keys=True)
@@ -0,0 +1,107 @@
+"""
+XuffIndex
+
+A run-long snapshot of directory listings, so that the many steps that
+walk the same trees (<treefile>, <xsltree>, <copytree>, <upload>) only
+list each directory once.
+"""
+
+import os
+import threading
+
+from . import XuffTrace
+
+def _parentDirs(path):
+    """`path`'s directory, and all its parents."""
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        yield parent
+        path = parent
+
+class DirIndex:
+    """
+    Directory listings, made with os.scandir the first time a directory is
+    asked for, and then reused.  The entries are os.DirEntry objects, which
+    remember their types, and their stat once it's been asked for.
+
+    The snapshot doesn't notice changes on its own: whatever changes files
+    has to `invalidate` them.  xuff does that for the files it writes, and
+    `clear` starts afresh for a new run.
+    """
+    def __init__(self):
+        self.dirs = {}
+        self.lock = threading.Lock()
+        self.nlisted = 0
+        self.nreused = 0
+
+    def listdir(self, path):
+        """
+        The os.DirEntry's in the directory `path`.  Raises OSError if it
+        can't be listed.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entries = self.dirs.get(path)
+            if entries is not None:
+                self.nreused += 1
+                return entries
+        with XuffTrace.span('listdir', 'io', path=path):
+            with os.scandir(path) as it:
+                entries = list(it)
+        with self.lock:
+            self.dirs[path] = entries
+            self.nlisted += 1
+        return entries
+
+    def walkfiles(self, top):
+        """
+        Yield (path, entry) for every file under `top`, recursively, with
+        paths starting with `top`.  Like path.Path.walkfiles, dot-directories
+        are included and symlinks to directories are followed, and a
+        directory that can't be listed raises OSError: an uploader mustn't
+        take a missing tree for an empty one.
+        """
+        entries = self.listdir(top)
+        for entry in entries:
+            path = os.path.join(top, entry.name)
+            try:
+                if entry.is_dir():
+                    yield from self.walkfiles(path)
+                elif entry.is_file():
+                    yield path, entry
+            except OSError:
+                continue
+
+    def invalidate(self, path):
+        """
+        The file `path` has been written: forget its directory's listing.
+        Writing a file can make its directories too, so their parents'
+        listings are forgotten as well, which is cheap: most won't have been
+        listed.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            if self.dirs:
+                for d in _parentDirs(path):
+                    self.dirs.pop(d, None)
+
+    def invalidateTree(self, path):
+        """The file or directory `path` has been removed: forget it all."""
+        self.invalidate(path)
+        path = os.path.abspath(path)
+        below = path + os.sep
+        with self.lock:
+            for d in [d for d in self.dirs if d == path or d.startswith(below)]:
+                del self.dirs[d]
+
+    def clear(self):
+        """Forget everything, for a new run."""
+        with self.lock:
+            self.dirs = {}
+
+    def report(self):
+        return "%d directories listed, %d listings reused" % (self.nlisted, self.nreused)
+
+index = DirIndex()
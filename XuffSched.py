@@ -0,0 +1,75 @@
+"""
+XuffSched
+
+Run the steps of a xuff script concurrently, as far as their data
+dependencies allow.
+"""
+
+import concurrent.futures
+
+from .XuffDeps import overlaps
+
+def anyOverlap(paths1, paths2):
+    return any(overlaps(p1, p2) for p1 in paths1 for p2 in paths2)
+
+def conflicts(io1, io2):
+    """
+    Must two steps with these (reads, writes, readsMore) triples run in
+    order?  A None means the step's effects are unknown, so it must.
+    readsMore means the step may read files besides its `reads`, so it
+    must stay in order with any step that writes.
+    """
+    if io1 is None or io2 is None:
+        return True
+    reads1, writes1, readsMore1 = io1
+    reads2, writes2, readsMore2 = io2
+    if (readsMore1 and writes2) or (readsMore2 and writes1):
+        return True
+    return (
+        anyOverlap(writes1, reads2) or
+        anyOverlap(writes1, writes2) or
+        anyOverlap(reads1, writes2)
+        )
+
+def dependencies(ios):
+    """
+    For each step's (reads, writes, readsMore) in `ios`, the set of indexes of the
+    earlier steps that it has to wait for.
+    """
+    waits = []
+    for j, io in enumerate(ios):
+        waits.append(set(i for i in range(j) if conflicts(ios[i], io)))
+    return waits
+
+def runSteps(run, steps, ios, jobs):
+    """
+    Call `run` on each of `steps`, using up to `jobs` threads.  `ios` are
+    the steps' (reads, writes, readsMore) triples, and a step only starts once every
+    earlier step it conflicts with is done.  If a step fails, no more are
+    started, and the first exception is raised once the running ones end.
+    """
+    waits = dependencies(ios)
+    pending = list(range(len(steps)))
+    running = {}
+    done = set()
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            if error is None:
+                for i in list(pending):
+                    if waits[i] <= done:
+                        pending.remove(i)
+                        running[pool.submit(run, steps[i])] = i
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in finished:
+                i = running.pop(fut)
+                try:
+                    fut.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+                done.add(i)
+    if error is not None:
+        raise error
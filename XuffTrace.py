@@ -0,0 +1,68 @@
+"""
+XuffTrace
+
+Record spans of time in Chrome's trace-event format, to be loaded into a
+trace viewer (chrome://tracing, Perfetto) to see where a build spends
+its time.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+class Tracer:
+    """
+    Collects trace events.  Until `start` is called, spans cost almost
+    nothing and record nothing.
+    """
+    def __init__(self):
+        self.events = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.events = []
+
+    def isTracing(self):
+        return self.events is not None
+
+    @contextlib.contextmanager
+    def span(self, name, cat, /, **args):
+        """A context manager recording the time spent inside it."""
+        if self.events is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.add({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+                })
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def takeEvents(self):
+        """Return the events collected so far, and forget them."""
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    def write(self, fname):
+        """Write the events to `fname` as a Chrome trace file."""
+        with open(fname, 'w') as f:
+            json.dump({'traceEvents': self.events or [], 'displayTimeUnit': 'ms'}, f)
+
+tracer = Tracer()
+span = tracer.span
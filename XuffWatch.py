@@ -0,0 +1,154 @@
+"""
+XuffWatch
+
+Run xuff scripts, then keep watching their inputs, re-running only the
+steps affected by a change.
+"""
+
+import os
+import time
+
+from . import XsltExtensions
+from . import XuffApp
+from . import XuffDeps
+from . import XuffIndex
+from .XuffDeps import isUnder, overlaps
+
+def snapshot(paths):
+    """
+    Stat all the files in `paths`, recursing into directories.  Returns
+    a dict mapping absolute file paths to XuffDeps.fileStamp values.
+    """
+    snap = {}
+    for path in paths:
+        if path.startswith('mem:') or path in snap:
+            continue
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                # Like DirWalker, don't go into dot-directories.
+                dirnames[:] = [d for d in dirnames if d[0] != '.']
+                for f in filenames:
+                    fpath = os.path.join(dirpath, f)
+                    snap[fpath] = XuffDeps.fileStamp(fpath)
+        else:
+            snap[path] = XuffDeps.fileStamp(path)
+    return snap
+
+def changedPaths(old, new):
+    """The paths that are different between two snapshots."""
+    changed = set()
+    for path in set(old) | set(new):
+        if old.get(path) != new.get(path):
+            changed.add(path)
+    return changed
+
+class Watcher:
+    """
+    Runs the xuff `scripts` with `app`, then polls their inputs every
+    `interval` seconds.  Only the steps reading something that changed
+    are run again, and for <xsltree>, only the changed source files are
+    transformed.
+
+    Everything runs in this one process, so the compiled stylesheets,
+    parsed documents and image sizes stay cached between rebuilds.
+    """
+    def __init__(self, app, scripts, interval=0.5):
+        self.app = app
+        self.scripts = [os.path.abspath(s) for s in scripts]
+        self.interval = interval
+        self.steps = []
+        self.watched = []
+        self.snap = {}
+
+    def run(self):
+        self.build()
+        print("Watching for changes, ^C to stop.")
+        try:
+            while True:
+                time.sleep(self.interval)
+                changed = changedPaths(self.snap, snapshot(self.watched))
+                if changed:
+                    self.rebuild(changed)
+        except KeyboardInterrupt:
+            pass
+
+    def build(self):
+        """Run all the scripts, noting the steps they execute."""
+        self.app.stepLog = []
+        try:
+            for s in self.scripts:
+                self.app.processFile(s)
+        finally:
+            self.steps = []
+            for e, loaded in self.app.stepLog:
+                self.steps.append([e, sorted(loaded)])
+            self.app.stepLog = None
+        self.takeSnapshot()
+
+    def stepReads(self, e, loaded):
+        io = self.app.stepIO(e)
+        if io is None:
+            return None, None
+        reads, writes = io
+        return reads + loaded, writes
+
+    def takeSnapshot(self):
+        """Note the current state of everything the steps read."""
+        self.watched = list(self.scripts)
+        for e, loaded in self.steps:
+            reads, writes = self.stepReads(e, loaded)
+            if reads:
+                self.watched.extend(reads)
+        self.snap = snapshot(self.watched)
+
+    def rebuild(self, changed):
+        """Re-run the steps affected by the `changed` paths."""
+        start = time.time()
+        # Images may have changed: have the cache check them again (cheaply).
+        XsltExtensions.imgsizecache.newRun()
+        # Directories may have changed too: list them afresh.
+        XuffIndex.index.clear()
+        XuffApp.output.forgetDirs()
+        if any(s in changed for s in self.scripts):
+            print("Script changed, running everything")
+            try:
+                self.build()
+            except Exception as e:
+                print("*** %s" % e)
+            return
+
+        dirty = set(changed)
+        nsteps = 0
+        for step in self.steps:
+            e, loaded = step
+            reads, writes = self.stepReads(e, loaded)
+            if reads is None:
+                continue
+            hits = [p for p in dirty if any(overlaps(p, r) for r in reads)]
+            if not hits:
+                continue
+
+            only = None
+            if self.app.local_name(e) == 'xsltree':
+                # If only source files changed, just transform those.
+                src = reads[0]
+                if all(p in changed and isUnder(p, src) and p not in reads[1:] for p in hits):
+                    only = set(hits)
+
+            self.app.onlyFiles = only
+            try:
+                self.app.runStep(e)
+            except Exception as exc:
+                print("*** %s" % exc)
+                continue
+            finally:
+                self.app.onlyFiles = None
+            nsteps += 1
+            if only is None:
+                step[1] = sorted(self.app.loaded)
+            else:
+                step[1] = sorted(set(loaded) | self.app.loaded)
+            dirty.update(writes)
+
+        self.takeSnapshot()
+        print("%d changed, %d steps re-run in %.2f sec" % (len(changed), nsteps, time.time() - start))
@@ -0,0 +1,133 @@
+"""
+Benchmark FtpUpload over different numbers of connections.
+
+    python ftpupload.py [LATENCY_MS]
+
+Uploads generated trees of files, one spread over 40 directories and one
+all in a single directory, to a stand-in FTP server living in this
+process, which sleeps for the round-trip latency (default 20 ms) on every
+command, and for the transfer time of the data at 10 MB/s per connection.
+Each run starts with an empty server and no md5 file, so every file is
+uploaded.  The server's files are checked against the originals, and the
+number of logins is reported.
+"""
+
+import ftplib
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from blogtools import FtpUpload
+
+class StandInServer:
+    """The files and directories on the stand-in server."""
+    def __init__(self, latency, bandwidth=10e6):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.dirs = set([''])
+        self.files = {}
+        self.logins = 0
+        self.lock = threading.Lock()
+
+class StandInFtp:
+    """Enough of ftplib.FTP for FtpUpload, talking to a StandInServer."""
+    def __init__(self, server):
+        self.server = server
+        self.cwdPath = ''
+        with server.lock:
+            server.logins += 1
+        self.roundTrip()
+
+    def roundTrip(self, nbytes=0):
+        time.sleep(self.server.latency + nbytes / self.server.bandwidth)
+
+    def set_pasv(self, val):
+        pass
+
+    def cwd(self, d):
+        self.roundTrip()
+        if d == '..':
+            path = os.path.dirname(self.cwdPath)
+        else:
+            path = os.path.join(self.cwdPath, d)
+        with self.server.lock:
+            if path not in self.server.dirs:
+                raise ftplib.error_perm("550 No such directory")
+        self.cwdPath = path
+
+    def mkd(self, d):
+        self.roundTrip()
+        with self.server.lock:
+            self.server.dirs.add(os.path.join(self.cwdPath, d))
+
+    def storbinary(self, cmd, f):
+        data = f.read()
+        # PASV, then STOR and the data.
+        self.roundTrip()
+        self.roundTrip(len(data))
+        with self.server.lock:
+            self.server.files[os.path.join(self.cwdPath, cmd[5:])] = data
+
+    storlines = storbinary
+
+    def delete(self, name):
+        self.roundTrip()
+        with self.server.lock:
+            self.server.files.pop(os.path.join(self.cwdPath, name), None)
+
+    def quit(self):
+        self.roundTrip()
+
+class StandInUpload(FtpUpload.FtpUpload):
+    def __init__(self, server):
+        FtpUpload.FtpUpload.__init__(self)
+        self.server = server
+
+    def connect(self):
+        return StandInFtp(self.server)
+
+def makeTree(dirname, ndirs=40, nfiles=25):
+    rand = random.Random(17)
+    for d in range(ndirs):
+        sub = os.path.join(dirname, "d%02d" % d)
+        os.makedirs(sub)
+        for i in range(nfiles):
+            with open(os.path.join(sub, "f%02d.html" % i), "wb") as f:
+                f.write(os.urandom(rand.randint(1000, 50000)))
+
+def upload(src, latency, connections):
+    server = StandInServer(latency)
+    fu = StandInUpload(server)
+    fu.setHost('standin', 'user', 'password', connections)
+    start = time.perf_counter()
+    fu.upload(src=src, text='', binary='*.html')
+    fu.finish()
+    return time.perf_counter() - start, server
+
+def main(args):
+    latency = float(args[0]) / 1000 if args else 0.020
+    for ndirs, nfiles in [(40, 25), (1, 1000)]:
+        src = tempfile.mkdtemp(prefix='ftpupload-')
+        makeTree(src, ndirs, nfiles)
+        print("%d files in %d directories, %.0f ms latency" % (ndirs * nfiles, ndirs, latency * 1000))
+
+        base = None
+        for connections in [1, 2, 4, 8]:
+            elapsed, server = upload(src, latency, connections)
+            base = base or elapsed
+            bad = 0
+            for dirpath, dirnames, filenames in os.walk(src):
+                for f in filenames:
+                    path = os.path.join(dirpath, f)
+                    with open(path, "rb") as fin:
+                        if server.files.get(os.path.relpath(path, src)) != fin.read():
+                            bad += 1
+            print("%d connections: %6.2f sec, %4.1fx, %d logins%s" % (
+                connections, elapsed, base / elapsed, server.logins,
+                ", %d files wrong" % bad if bad else ""))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,71 @@
+"""
+Benchmark ImageSize.imageSize against opening images with PIL.
+
+    python imgsize.py [DIR]
+
+Measures every image under DIR both ways, checking that they agree.
+Without DIR, a few thousand images of assorted formats and sizes are
+generated in a temporary directory first.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from blogtools.ImageSize import imageSize
+
+FORMATS = [('PNG', '.png'), ('GIF', '.gif'), ('JPEG', '.jpg'), ('WEBP', '.webp')]
+
+def makeImages(dirname, count=3000):
+    rand = random.Random(17)
+    for i in range(count):
+        fmt, ext = FORMATS[i % len(FORMATS)]
+        size = (rand.randint(1, 1600), rand.randint(1, 1200))
+        sub = os.path.join(dirname, "d%02d" % (i % 30))
+        os.makedirs(sub, exist_ok=True)
+        Image.new('RGB', size, (i % 256, 80, 160)).save(os.path.join(sub, "img%05d%s" % (i, ext)), fmt)
+
+def allFiles(dirname):
+    for dirpath, dirnames, filenames in os.walk(dirname):
+        for f in filenames:
+            yield os.path.join(dirpath, f)
+
+def pilSize(path):
+    return Image.open(path).size
+
+def timeit(fn, paths):
+    start = time.perf_counter()
+    sizes = [fn(p) for p in paths]
+    return time.perf_counter() - start, sizes
+
+def main(args):
+    if args:
+        dirname = args[0]
+    else:
+        dirname = tempfile.mkdtemp(prefix='imgsize-')
+        print("Making images in %s" % dirname)
+        makeImages(dirname)
+
+    paths = sorted(allFiles(dirname))
+    # Read them all once so both ways see a warm disk cache.
+    for p in paths:
+        with open(p, 'rb') as f:
+            f.read()
+
+    pilTime, pilSizes = timeit(pilSize, paths)
+    ourTime, ourSizes = timeit(imageSize, paths)
+
+    differ = [p for p, a, b in zip(paths, pilSizes, ourSizes) if tuple(a) != tuple(b)]
+    print("%d images" % len(paths))
+    print("PIL:       %.3f sec (%.1f usec/image)" % (pilTime, pilTime / len(paths) * 1e6))
+    print("ImageSize: %.3f sec (%.1f usec/image)" % (ourTime, ourTime / len(paths) * 1e6))
+    print("Speedup:   %.1fx" % (pilTime / ourTime))
+    if differ:
+        print("%d sizes differ, e.g. %s" % (len(differ), differ[0]))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
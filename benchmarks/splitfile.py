@@ -0,0 +1,134 @@
+"""
+Benchmark the iterparse FileSplitter against the SAX splitter it replaced.
+
+    python splitfile.py [NFILES]
+
+Generates a splitfile input with NFILES <file> elements (default 20000)
+in a temporary directory, then splits it with each splitter twice: once
+into an empty directory, and once more over its own output, when nothing
+has changed.  Each split runs in its own process, so its peak memory can
+be reported too.  The two splitters' outputs are checked to be the same
+bytes.
+"""
+
+import io
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from xml.sax import make_parser, handler, saxutils
+
+from blogtools import XuffApp
+
+class SaxFileSplitter(handler.ContentHandler):
+    """The old <splitfile> implementation."""
+    def __init__(self, dst='.'):
+        self.xmlgen = None
+        self.dirStack = [dst]
+
+    def startElement(self, name, attrs):
+        if name == 'directory':
+            self.dirStack.append(os.path.join(self.dirStack[-1], attrs['name']))
+        elif name == 'file':
+            self.fpath = os.path.join(self.dirStack[-1], attrs['name'])
+            self.outf = io.StringIO()
+            self.outf.write('<?xml version="1.0" encoding="utf-8"?>')
+            self.xmlgen = saxutils.XMLGenerator(self.outf, 'utf-8')
+        else:
+            self.xmlgen.startElement(name, attrs)
+
+    def endElement(self, name):
+        if name == 'directory':
+            self.dirStack = self.dirStack[:-1]
+        elif name == 'file':
+            self.xmlgen = None
+            XuffApp.output.write(self.fpath, self.outf.getvalue().encode('utf-8'))
+            self.outf = None
+        else:
+            self.xmlgen.endElement(name)
+
+    def characters(self, content):
+        if self.xmlgen:
+            self.xmlgen.characters(content)
+
+def saxSplit(inf, dst):
+    parser = make_parser()
+    parser.setContentHandler(SaxFileSplitter(dst))
+    parser.parse(inf)
+
+def lxmlSplit(inf, dst):
+    XuffApp.FileSplitter(dst).split(inf)
+
+splitters = {'sax': saxSplit, 'lxml': lxmlSplit}
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+def makeInput(fname, nfiles):
+    rand = random.Random(17)
+    with open(fname, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<directory name=".">\n')
+        for d in range(nfiles // 100 + 1):
+            f.write('<directory name="d%03d">\n' % d)
+            for i in range(min(100, nfiles - d * 100)):
+                f.write('<file name="f%05d.html"><html><head><title>Page %d</title><script src="x.js"></script></head><body>\n' % (i, i))
+                for p in range(rand.randint(3, 30)):
+                    words = " ".join(rand.choice(WORDS) for w in range(rand.randint(10, 60)))
+                    f.write('<p class="c%d">%s <a href="p%d.html">link &amp; more</a> café.</p>\n' % (p, words, p))
+                f.write('<div class="clear"></div><br/></body></html></file>\n')
+            f.write('</directory>\n')
+        f.write('</directory>\n')
+
+def runOne(kind, inf, dst):
+    """Split in this process, printing the time and peak memory."""
+    start = time.perf_counter()
+    splitters[kind](inf, dst)
+    elapsed = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%f %d %s" % (elapsed, maxrss, XuffApp.output.report()))
+
+def timeSplit(kind, inf, dst):
+    out = subprocess.check_output([sys.executable, __file__, '--one', kind, inf, dst], text=True)
+    elapsed, maxrss, report = out.split(None, 2)
+    return float(elapsed), int(maxrss), report.strip()
+
+def contents(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def compareDirs(dir1, dir2):
+    differ = 0
+    nfiles = 0
+    for dirpath, dirnames, filenames in os.walk(dir1):
+        for f in filenames:
+            p1 = os.path.join(dirpath, f)
+            p2 = os.path.join(dir2, os.path.relpath(p1, dir1))
+            nfiles += 1
+            if contents(p1) != contents(p2):
+                differ += 1
+    return nfiles, differ
+
+def main(args):
+    nfiles = int(args[0]) if args else 20000
+    tmp = tempfile.mkdtemp(prefix='splitfile-')
+    inf = os.path.join(tmp, 'split.xml')
+    makeInput(inf, nfiles)
+    print("Input: %d files, %.1f MB, in %s" % (nfiles, os.path.getsize(inf) / 1e6, tmp))
+
+    for kind in ['sax', 'lxml']:
+        dst = os.path.join(tmp, kind)
+        for run in ['first', 'again']:
+            elapsed, maxrss, report = timeSplit(kind, inf, dst)
+            print("%-5s %-6s %7.3f sec, peak %4d MB: %s" % (kind, run, elapsed, maxrss // 1024, report))
+
+    checked, differ = compareDirs(os.path.join(tmp, 'sax'), os.path.join(tmp, 'lxml'))
+    print("%d files compared, %d differ" % (checked, differ))
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--one']:
+        runOne(*sys.argv[2:5])
+    else:
+        main(sys.argv[1:])
@@ -3,65 +3,10 @@ Ned Batchelder, 12/14/2001
 http://www.nedbatchelder.com
 """
 
-# Things that aren't right here:
-#   - I have a copy of the standard glob module (I forget why!)
-#   - The recursive mode is dumb: it works just as if you had typed
-#       "showfiles * *\* *\*\* *\*\*\* ... on the command line.
-#   - -rx gets confused by paths like foo.bar\something, where it thinks
-#       the extension is ".bar\something".
-
-import getopt, os, string, sys, time
+import fnmatch, getopt, os, re, sys, time
 from stat import *
 
-### Bogus: this is a tweaked copy of the standard glob module.
-import fnmatch, re
-
-def glob(pathname):
-    """Return a list of paths matching a pathname pattern.
-
-    The pattern may contain simple shell-style wildcards a la fnmatch.
-    """
-    if not has_magic(pathname):
-        if os.path.exists(pathname):
-            return [pathname]
-        else:
-            return []
-    dirname, basename = os.path.split(pathname)
-    if not dirname:
-        return glob1(os.curdir, basename)
-    elif has_magic(dirname):
-        list = glob(dirname)
-    else:
-        list = [dirname]
-    if not has_magic(basename):
-        result = []
-        for dirname in list:
-            if basename or os.path.isdir(dirname):
-                name = os.path.join(dirname, basename)
-                if os.path.exists(name):
-                    result.append(name)
-    else:
-        result = []
-        for dirname in list:
-            sublist = glob1(dirname, basename)
-            for name in sublist:
-                result.append(os.path.join(dirname, name))
-    return result
-
-def glob1(dirname, pattern):
-    if not dirname: dirname = os.curdir
-    try:
-        names = os.listdir(dirname)
-    except os.error:
-        return []
-    return fnmatch.filter(names,pattern)
-
-
-magic_check = re.compile('[*?[]')
-
-def has_magic(s):
-    return magic_check.search(s) is not None
-### end Bogus
+from blogtools import PathGlob
 
 if os.name == 'nt':
     import win32file
@@ -108,16 +53,18 @@ def formatSize(size):
     sl = [c for c in str(size)]
     for i in range(len(sl)-3, 0, -3):
         sl[i:i] = [',']
-    return string.join(sl, '')
+    return ''.join(sl)
 
 lineformat = '%18s %3s %11s %s'
 totalformat = '= %s bytes, %s files'
+summaryformat = '%15s %9s  %s'
 
 class FileEntry:
-    def __init__(self, filespec):
+    def __init__(self, filespec, stat=None):
         """
         Create a FileEntry from either a string, or a pair of strings
-        (directory, file).
+        (directory, file).  `stat` is the file's stat if it's already known,
+        from an os.DirEntry for example.
         """
         if type(filespec) == type(()):
             self.dir, self.name = filespec
@@ -127,7 +74,8 @@ class FileEntry:
             self.name = filespec
             self.path = filespec
             
-        stat = os.stat(self.path)
+        if stat is None:
+            stat = os.stat(self.path)
         self.size = stat[ST_SIZE]
         self.mod = stat[ST_MTIME]
         self.isDir = S_ISDIR(stat[ST_MODE])
@@ -144,142 +92,214 @@ class FileEntry:
         return self.name
 
     def lcaseName(self):
-        return string.lower(self.name)
+        return self.name.lower()
 
     def extension(self):
         """Return the extension of an entry"""
         if self.isDir:
             return '/'
-        elif self.name[1:].find('.') != -1:
-            return self.lcaseName().split('.')[-1]
+        base = os.path.basename(self.lcaseName())
+        if base[1:].find('.') != -1:
+            return base.split('.')[-1]
         else:
             return " "
 
-    
-def nameCompare(e1, e2):
-    """Case=insensitive compare"""
-    if e1.isDir and not e2.isDir:
-        return -1
-    if e2.isDir and not e1.isDir:
-        return 1
-    
-    s1 = e1.lcaseName()
-    s2 = e2.lcaseName()
-    if s1 < s2:
-        return -1
-    elif s1 > s2:
-        return 1
-    else:
-        return 0
-
-def sizeCompare(e1, e2):
-    """Compare by size"""
-    if e1.size < e2.size:
-        return -1
-    elif e1.size > e2.size:
-        return 1
-    else:
-        return 0
-    
-def dateCompare(e1, e2):
-    """Compare by date"""
-    if e1.mod < e2.mod:
-        return -1
-    elif e1.mod > e2.mod:
-        return 1
+
+def nameKey(e):
+    """Case-insensitive, directories first"""
+    return (not e.isDir, e.lcaseName())
+
+def sizeKey(e):
+    return e.size
+
+def dateKey(e):
+    return e.mod
+
+def extKey(e):
+    """By extension, directories first"""
+    return (not e.isDir, e.extension(), e.lcaseName())
+
+def specEntries(spec):
+    """The FileEntry's for one command-line spec."""
+    if os.access(spec, os.F_OK):
+        if os.path.isdir(spec):
+            with os.scandir(spec) as it:
+                found = list(it)
+            for entry in found:
+                if spec == '.':
+                    yield FileEntry(entry.name, entry.stat())
+                else:
+                    yield FileEntry((spec, entry.name), entry.stat())
+        else:
+            yield FileEntry(spec)
     else:
-        return 0
-
-def extCompare(e1, e2):
-    """Compare by extension"""
-    if e1.isDir and not e2.isDir:
-        return -1
-    if e2.isDir and not e1.isDir:
-        return 1
-    
-    x1 = e1.extension()
-    x2 = e2.extension()
-    if x1 < x2:
-        return -1
-    elif x1 > x2:
-        return 1
+        for f in PathGlob.iglob(spec):
+            yield FileEntry(f)
+
+def deepEntries(spec):
+    """
+    The FileEntry's for one command-line spec, recursively: everything
+    below a directory, or the names matching a pattern at any depth.
+    """
+    if os.path.isdir(spec):
+        dirs, pattern = [spec], '*'
     else:
-        return nameCompare(e1, e2)
+        dirname, pattern = os.path.split(spec)
+        if PathGlob.hasMagic(dirname):
+            dirs = PathGlob.iglob(dirname)
+        else:
+            dirs = [dirname]
+    match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+    for d in dirs:
+        if d in ('', '.'):
+            yield from walkEntries('', match)
+        elif os.path.isdir(d):
+            yield from walkEntries(d, match)
 
-def starify(s):
-    return [ i*'*/'+s for i in range(10) ]
-        
-def glue(l):
-    """Glue the elements of a list together: [[1,2], [3,4]] --> [1,2,3,4]"""
-    return reduce(lambda a,b: a+b, l)
+def specRoot(spec):
+    """The directory that a command-line spec's files are all under."""
+    if os.path.isdir(spec):
+        return spec
+    root = os.path.dirname(spec)
+    while PathGlob.hasMagic(root):
+        root = os.path.dirname(root)
+    return root
+
+def walkEntries(dirname, match):
+    """
+    Yield a FileEntry for each thing below `dirname` whose name matches
+    `match`.  Symlinks to directories aren't followed.
+    """
+    try:
+        with os.scandir(dirname or os.curdir) as it:
+            found = list(it)
+    except OSError:
+        return
+    for entry in found:
+        path = os.path.join(dirname, entry.name)
+        if match(os.path.normcase(entry.name)):
+            try:
+                yield FileEntry(path, entry.stat())
+            except OSError:
+                pass
+        if entry.is_dir(follow_symlinks=False):
+            yield from walkEntries(path, match)
+
+class Summary:
+    """
+    Totals of bytes and files, by directory and by extension.  Like du,
+    a directory's totals include its subdirectories, and only directories
+    at most `depth` levels down are shown.
+    """
+    def __init__(self, depth=None):
+        self.depth = depth
+        self.dirs = {}
+        self.exts = {}
+
+    def add(self, e, root=''):
+        """Count `e`, which came from a spec whose files are under `root`."""
+        if e.isDir:
+            return
+        self.count(self.exts, e.extension(), e.size)
+        top = os.path.normpath(root)
+        rel = os.path.relpath(os.path.dirname(os.path.normpath(e.path)) or os.curdir, top)
+        if rel == os.curdir:
+            parts = []
+        else:
+            parts = rel.split(os.sep)
+        ndirs = len(parts)
+        if self.depth is not None:
+            ndirs = min(ndirs, self.depth)
+        for i in range(ndirs + 1):
+            self.count(self.dirs, os.path.join(top, *parts[:i]), e.size)
+
+    def count(self, totals, key, size):
+        tot = totals.get(key)
+        if tot is None:
+            tot = totals[key] = [0, 0]
+        tot[0] += size
+        tot[1] += 1
+
+    def show(self):
+        for title, totals in [('Directories', self.dirs), ('Extensions', self.exts)]:
+            print(title + ':')
+            for key, (size, nfiles) in sorted(totals.items(), key=lambda kv: (-kv[1][0], kv[0])):
+                print(summaryformat % (formatSize(size), nfiles, key))
 
 def main(args):
 
     def usage():
-        print '-od -os -ox -d -s -x -r -b'
+        print('-od -os -ox -d -s -x -r -b -u -t -l depth')
         sys.exit()
         
     try:
-        opts, args = getopt.getopt(args, "bo:dsxr")
+        opts, args = getopt.getopt(args, "bo:dsxrutl:")
     except getopt.GetoptError:
         # print help information and exit:
         usage()
 
     # Collect the options
     
-    sortfn = nameCompare
+    sortkey = nameKey
     deep = 0
     brief = 0
+    summary = 0
+    depth = None
     
     for o, a in opts:
         if o == '-o':
             if a == 'd':
-                sortfn = dateCompare
+                sortkey = dateKey
             elif a == 's':
-                sortfn = sizeCompare
+                sortkey = sizeKey
             elif a == 'x':
-                sortfn = extCompare
+                sortkey = extKey
             else:
                 usage()
         elif o == '-d':
-            sortfn = dateCompare
+            sortkey = dateKey
         elif o == '-s':
-            sortfn = sizeCompare
+            sortkey = sizeKey
         elif o == '-x':
-            sortfn = extCompare
+            sortkey = extKey
         elif o == '-r':
             deep = 1
         elif o == '-b':
             brief = 1
+        elif o == '-u':
+            # Unsorted: print entries as they're found.
+            sortkey = None
+        elif o == '-t':
+            summary = 1
+        elif o == '-l':
+            depth = int(a)
         else:
             usage()
 
     # Collect the files
     
-    files = []
-
     specs = args or ['*']
     
     if deep:
-        specs = glue([starify(s) for s in specs])
-    for a in specs:
-        bFile = os.access(a, os.F_OK)
-        if bFile:
-            stat = os.stat(a)
-            if S_ISDIR(stat[ST_MODE]):
-                newFiles = os.listdir(a)
-                if a != '.':
-                    newFiles = map((lambda f,d=a: (d, f)), newFiles)
-                files += newFiles
-            else:
-                files += [a]
-        else:
-            files += glob(a)
-    entries = [ FileEntry(f) for f in files ]
+        getEntries = deepEntries
+    else:
+        getEntries = specEntries
+    entries = (e for spec in specs for e in getEntries(spec))
+
+    if summary:
+        # Totals only: no need to keep or sort the entries.
+        totals = Summary(depth)
+        for spec in specs:
+            root = specRoot(spec)
+            for e in getEntries(spec):
+                totals.add(e, root)
+        totals.show()
+        return
 
     # Sort the entries
     
-    entries.sort(sortfn)
+    if sortkey is not None:
+        entries = sorted(entries, key=sortkey)
 
     # Print the entries
     
@@ -289,12 +309,12 @@ def main(args):
         totsize += e.size
         nfiles += 1
         if brief:
-            print e.shortForm()
+            print(e.shortForm())
         else:
-            print e.longForm()
+            print(e.longForm())
         
     if not brief:
-        print totalformat % (formatSize(totsize), nfiles)
+        print(totalformat % (formatSize(totsize), nfiles))
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -8,5 +8,7 @@ http://www.nedbatchelder.com
 import sys
 from blogtools import XuffApp
 
-xa = XuffApp.XuffApp()
-xa.main(sys.argv)
+# Worker processes import this module again: only the real run runs.
+if __name__ == '__main__':
+    xa = XuffApp.XuffApp()
+    xa.main(sys.argv)
@@ -4,10 +4,22 @@ Directory walking, adapted from ASPN Cookbook.
 
 import fnmatch
 import os
+import re
 
 class DirWalker:
-    def __init__(self):
+    """
+    Walks a directory tree, calling the overridables for the directories,
+    and for the files matching the patterns.  Or iterate `events` to get
+    the same information without subclassing.
+
+    If `index` is given, it's an object with a `listdir` method returning
+    os.DirEntry's, to list directories with instead of os.scandir.
+    """
+    def __init__(self, index=None):
         self.patterns = []
+        self.matchers = []
+        self.start = '.'
+        self.index = index
         
     def startDir(self, dirName, dirPath):
         """Overridable for starting a directory"""
@@ -24,46 +36,80 @@ class DirWalker:
     def setPattern(self, pattern, index):
         while index >= len(self.patterns):
             self.patterns.append([])
+            self.matchers.append(None)
         self.patterns[index] = pattern.split()
-        
+        # All the patterns in the list, as one regex.
+        if self.patterns[index]:
+            regex = '|'.join(fnmatch.translate(os.path.normcase(pat)) for pat in self.patterns[index])
+            self.matchers[index] = re.compile(regex).match
+        else:
+            self.matchers[index] = None
+
+    def patIndex(self, fname):
+        """The index of the first pattern list matching `fname`, or None."""
+        fname = os.path.normcase(fname)
+        for iPat, matcher in enumerate(self.matchers):
+            if matcher is not None and matcher(fname):
+                return iPat
+        return None
+
+    def events(self, start, dname='.', dfull='.'):
+        """
+        Walk the tree at `start`, yielding ('startDir', dirName, dirPath),
+        ('file', fileName, path, patIndex) and ('endDir', dirName, dirPath)
+        tuples in the order the overridables would be called.
+        """
+        self.start = start
+        return self.walkdir(dname, dfull)
+
     def walkdir(self, dname, dfull):
         # must have at least root folder
         try:
-            names = os.listdir(dfull)
-        except os.error:
+            entries = self.listdir(self.realPath(dfull))
+        except OSError:
             return
 
-        self.startDir(dname, dfull)
+        yield ('startDir', dname, dfull)
         
         # check each file
-        for fname in names:
+        for entry in entries:
+            fname = entry.name
             fullname = os.path.normpath(os.path.join(dfull, fname))
 
             # grab if it matches our pattern and entry type
-            if os.path.isfile(fullname):
-                bHandled = 0
-                for iPat in range(len(self.patterns)):
-                    patList = self.patterns[iPat]
-                    for pat in patList:
-                        if fnmatch.fnmatch(fname, pat):
-                            self.file(fname, fullname, iPat)
-                            bHandled = 1
-                            break
-                    if bHandled:
-                        break
+            try:
+                isFile = entry.is_file()
+                isDir = not isFile and entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if isFile:
+                iPat = self.patIndex(fname)
+                if iPat is not None:
+                    yield ('file', fname, fullname, iPat)
 
             # recursively scan other folders
-            if os.path.isdir(fullname) and not os.path.islink(fullname):
-                if fname[0] != '.':
-                    self.walkdir(fname, fullname)
+            elif isDir and fname[0] != '.':
+                yield from self.walkdir(fname, fullname)
+
+        yield ('endDir', dname, dfull)
 
-        self.endDir(dname, dfull)
+    def listdir(self, path):
+        if self.index is not None:
+            return self.index.listdir(path)
+        with os.scandir(path) as it:
+            return list(it)
 
-    def walk(self, start, dname, dfull):
-        olddir = os.getcwd()
-        os.chdir(start)
-        self.walkdir(dname, dfull)
-        os.chdir(olddir)
+    def realPath(self, path):
+        """
+        The paths given to the overridables are relative to the start of
+        the walk.  This is the path to use to actually get at the file.
+        """
+        return os.path.join(self.start, path)
+
+    def walk(self, start, dname='.', dfull='.'):
+        # Don't chdir: other threads may be using the current directory.
+        for event in self.events(start, dname, dfull):
+            getattr(self, event[0])(*event[1:])
 
 if __name__ == '__main__':
     # test code
@@ -87,3 +133,9 @@ if __name__ == '__main__':
     walker.setPattern('*.py', 0)
     walker.setPattern('*.xml', 1)
     walker.walk('.', '.')
+
+    print('\nExample 3:')
+    walker = DirWalker()
+    walker.setPattern('*.py *.xml', 0)
+    for event in walker.events('.'):
+        print(*event)